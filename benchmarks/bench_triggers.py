@@ -0,0 +1,56 @@
+""" Benchmark the cost of setting and scanning for literal triggers against the number of literals.
+
+Run from the repository root with: python benchmarks/bench_triggers.py
+
+The triggers module is loaded on its own, so that the benchmark runs without the bot's dependencies.
+"""
+
+import importlib.util
+import os
+import random
+import string
+import timeit
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "pcbot", "triggers.py")
+spec = importlib.util.spec_from_file_location("triggers", path)
+triggers = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(triggers)
+
+literal_counts = (100, 1000, 5000, 20000)
+scans = 1000
+
+random.seed(0)
+words = ["".join(random.choice(string.ascii_lowercase) for _ in range(random.randint(3, 12))) for _ in range(200)]
+messages = [" ".join(random.choice(words) for _ in range(random.randint(5, 60))) for _ in range(scans)]
+
+
+def random_literal():
+    """ Return a random literal of 4 to 16 characters, which is unlikely to be in any message. """
+    return "".join(random.choice(string.ascii_lowercase + "!?") for _ in range(random.randint(4, 16)))
+
+
+def main():
+    print("{:>8} {:>12} {:>12} {:>14} {:>14}".format(
+        "literals", "set (ms)", "build (ms)", "scan (us/msg)", "author (us/msg)"))
+
+    for count in literal_counts:
+        literals = [random_literal() for _ in range(count)]
+
+        # Setting the triggers is cheap; the automaton is built on the first scan after a change
+        set_time = timeit.timeit(lambda: triggers.set_triggers("bench", literals=literals), number=1)
+        build_time = timeit.timeit(lambda: triggers.scan(messages[0]), number=1)
+        scan_time = timeit.timeit(lambda: [triggers.scan(m) for m in messages], number=1)
+
+        # Author triggers are only scanned for in the messages of their author
+        triggers.remove_triggers("bench")
+        for i in range(0, count, 10):
+            triggers.set_author_triggers("bench", str(i), literals=literals[i:i + 10])
+        author_time = timeit.timeit(lambda: [triggers.scan(m, author_id="0") for m in messages], number=1)
+        triggers.remove_triggers("bench")
+
+        print("{:>8} {:>12.2f} {:>12.2f} {:>14.1f} {:>14.1f}".format(
+            count, set_time * 1000, build_time * 1000, scan_time / scans * 1e6, author_time / scans * 1e6))
+
+
+if __name__ == "__main__":
+    main()
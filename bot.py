@@ -9,15 +9,18 @@ import inspect
 import os
 import sys
 import traceback
+from collections import defaultdict
 from copy import copy
 from datetime import datetime
+from functools import partial
+from io import BytesIO
 from getpass import getpass
 from argparse import ArgumentParser
 
 import discord
 import asyncio
 
-from pcbot import utils, config
+from pcbot import utils, config, log, triggers, sendqueue
 import plugins
 
 # Sets the version to enable accessibility for other modules
@@ -31,6 +34,10 @@ class Client(discord.Client):
         super().__init__(**kwargs)
         self.time_started = datetime.utcnow()
         self.last_deleted_messages = []
+        self.memberships = defaultdict(dict)  # user_id: {server_id: discord.Member}
+        self.message_waiters = {}  # channel_id or None: {author_id or None: [(predicate, future)]}
+        self.response_recorders = {}  # asyncio.Task: (channel_id, list of plugins.Reply or None when not cacheable)
+        self.send_queues = {}  # destination id: sendqueue.SendQueue
 
     async def _handle_event(self, func, event, *args, **kwargs):
         """ Handle the event dispatched. """
@@ -41,15 +48,62 @@ class Client(discord.Client):
                 message = args[0]
                 await self.send_message(message.channel, str(e))
             else:
-                logging.error(traceback.format_exc())
+                logging.exception("An error occurred in event %s", event)
                 await self.on_error(event, *args, **kwargs)
         except:
-            logging.error(traceback.format_exc())
+            logging.exception("An error occurred in event %s", event)
             await self.on_error(event, *args, **kwargs)
         else:
             if result is True and event == "message":
                 log_message(args[0], prefix="... ")
 
+    def _add_server_memberships(self, server: discord.Server):
+        """ Add every member of a server to the memberships index. """
+        for member in server.members:
+            self.memberships[member.id][server.id] = member
+
+    def _remove_server_memberships(self, server: discord.Server):
+        """ Remove every member of a server from the memberships index. """
+        for member in server.members:
+            self._remove_membership(member.id, server.id)
+
+    def _remove_membership(self, user_id: str, server_id: str):
+        """ Remove a single membership and drop the user when they have none left. """
+        servers = self.memberships.get(user_id)
+        if servers is None:
+            return
+
+        servers.pop(server_id, None)
+        if not servers:
+            del self.memberships[user_id]
+
+    def update_memberships(self, event, *args):
+        """ Keep the user id to memberships index up to date with the given event. """
+        if event == "ready":
+            self.memberships.clear()
+            for server in self.servers:
+                self._add_server_memberships(server)
+        elif event == "member_join":
+            self.memberships[args[0].id][args[0].server.id] = args[0]
+        elif event == "member_remove":
+            self._remove_membership(args[0].id, args[0].server.id)
+        elif event in ("server_join", "server_available"):
+            self._add_server_memberships(args[0])
+        elif event in ("server_remove", "server_unavailable"):
+            self._remove_server_memberships(args[0])
+
+    def get_memberships(self, user_id: str):
+        """ Return a list of the discord.Member objects of this user in every server
+        the bot shares with them. """
+        return list(self.memberships.get(user_id, {}).values())
+
+    def get_any_member(self, user_id: str):
+        """ Return the discord.Member of this user in any shared server, or None. """
+        for member in self.memberships.get(user_id, {}).values():
+            return member
+
+        return None
+
     def dispatch(self, event, *args, **kwargs):
         """ Override event dispatch to handle plugin events. """
         # Exclude blank messages
@@ -68,10 +122,16 @@ class Client(discord.Client):
                 member = arg.author
                 break
 
+        # Keep the member and channel lookup indexes in sync before anything handles the event
+        utils.update_indexes(event, *args)
+        self.update_memberships(event, *args)
+        plugins.update_permission_cache(event, *args)
+
         super().dispatch(event, *args, **kwargs)
 
         # We get the method name and look through our plugins' event listeners
         method = "on_" + event
+        context, matched_triggers, changes = None, None, None
         if method in plugins.events:
             for func in plugins.events[method]:
                 # We'll only ignore bot messages if the event has disabled for bots
@@ -80,18 +140,57 @@ class Client(discord.Client):
                 # Same goes for messages sent by ourselves. Naturally this requires func.bot == True
                 if member and member == client.user and not func.self:
                     continue
+
+                # Skip message listeners whose triggers are not in the message. The message is scanned only once
+                if event == "message" and getattr(func, "triggers", None) is not None:
+                    if context is None:
+                        context = utils.MessageContext(args[0])
+                    if matched_triggers is None:
+                        matched_triggers = triggers.scan(context.content, context.lower_content, args[0].author.id)
+                    if func.triggers not in matched_triggers:
+                        continue
+
+                # Skip member update listeners when none of their subscribed fields changed, so that
+                # presence churn never schedules a task. The changes are computed only once
+                if event == "member_update" and getattr(func, "changes", None) is not None:
+                    if changes is None:
+                        changes = plugins.member_changes(*args)
+                    if not changes & func.changes:
+                        continue
+
+                # Listeners may share the pre-parsed context of the message, which is created only once
+                if event == "message" and getattr(func, "pass_context", False):
+                    if context is None:
+                        context = utils.MessageContext(args[0])
+                    client.loop.create_task(self._handle_event(func, event, *args, context=context, **kwargs))
+                    continue
+
+                # Member update listeners may likewise be given the changed fields
+                if event == "member_update" and getattr(func, "pass_context", False):
+                    if changes is None:
+                        changes = plugins.member_changes(*args)
+                    client.loop.create_task(self._handle_event(func, event, *args, context=changes, **kwargs))
+                    continue
+
                 client.loop.create_task(self._handle_event(func, event, *args, **kwargs))
 
-    async def send_message(self, destination, content=None, *args, **kwargs):
+    async def send_message(self, destination, content=None, *args, background=False, coalesce=False, **kwargs):
+        """ Override send_message to queue messages per channel, keeping under the rate limit.
+
+        :param background: Send after any interactive messages queued to the channel, e.g. for notifications.
+        :param coalesce: Allow the content to be joined with consecutive coalesced messages to the
+            channel. Messages with an embed or tts are never coalesced.
+        :return: The sent discord.Message. Coalesced messages all return the same message, which
+            has the content of every message joined into it.
+        """
         # Convert content to str, but also log this since it shouldn't happen
         if content is not None:
             if type(content) is not str:
                 # Log the traceback too when the content is an exception (it was probably meant to be
                 # converted to string) as to make debugging easier
-                tb = ""
-                if isinstance(content, Exception):
-                    tb = "\n" + "\n".join(traceback.format_exception(type(content), content, content.__traceback__))
-                logging.warning("type '{}' was passed to client.send_message: {}{}".format(type(content), content, tb))
+                exc_info = (type(content), content, content.__traceback__) if isinstance(content, Exception) else None
+                logging.warning("type '%s' was passed to client.send_message: %s", type(content), content,
+                                exc_info=exc_info)
 
                 content = str(content)
 
@@ -99,15 +198,80 @@ class Client(discord.Client):
             if not kwargs.pop("allow_everyone", None):
                 content = content.replace("@everyone", "@ everyone").replace("@here", "@ here")
 
-        return await super().send_message(destination, content, *args, **kwargs)
+        async def send(queued_content):
+            return await super(Client, self).send_message(destination, queued_content, *args, **kwargs)
+
+        coalesce = coalesce and not args and not kwargs.get("embed") and not kwargs.get("tts")
+        message = await self.get_send_queue(destination).put(send, content, background, coalesce)
+        self._record_reply(destination, plugins.Reply(content, kwargs.get("embed"), kwargs.get("tts", False),
+                                                      None, None))
+        return message
 
     async def send_file(self, destination, fp, *, filename=None, content=None, tts=False):
         """ Override send_file to notify the server when an attachment could not be sent. """
+        async def send(_):
+            return await super(Client, self).send_file(destination, fp, filename=filename, content=content, tts=tts)
+
+        # Files share the channel's send queue, so that they are sent in order with messages
         try:
-            return await super().send_file(destination, fp, filename=filename, content=content, tts=tts)
+            message = await self.get_send_queue(destination).put(send)
         except discord.errors.Forbidden:
+            self._record_reply(destination, None)
             return await self.send_message(destination, "**I don't have the permissions to send my attachment.**")
 
+        # Files are recorded by path or by their contents
+        if type(fp) is str or type(fp) is bytes:
+            data = fp
+        elif callable(getattr(fp, "getvalue", None)):
+            data = fp.getvalue()
+        else:
+            data = None
+
+        self._record_reply(destination, plugins.Reply(content, None, tts, data, filename) if data else None)
+        return message
+
+    def get_send_queue(self, destination):
+        """ Return the send queue of a destination, creating it if needed. The queue is
+        removed again once it is done sending. """
+        if destination.id not in self.send_queues:
+            self.send_queues[destination.id] = sendqueue.SendQueue(
+                self.loop, on_done=partial(self._remove_send_queue, destination.id))
+
+        return self.send_queues[destination.id]
+
+    def _remove_send_queue(self, destination_id: str, queue: sendqueue.SendQueue):
+        """ Remove a send queue which is done sending. """
+        if self.send_queues.get(destination_id) is queue:
+            del self.send_queues[destination_id]
+
+    @property
+    def queued_messages(self):
+        """ The number of messages waiting in every send queue. """
+        return sum(len(queue) for queue in self.send_queues.values())
+
+    def _record_reply(self, destination, reply: plugins.Reply):
+        """ Record a reply sent by a command with a response cache. A reply of None, or a reply
+        sent anywhere but the command's channel, means the command's replies can not be cached. """
+        task = asyncio.Task.current_task(loop=self.loop)
+        if self.response_recorders.get(task, (None, None))[1] is None:
+            return
+
+        channel_id, replies = self.response_recorders[task]
+        if reply is None or not getattr(destination, "id", None) == channel_id:
+            self.response_recorders[task] = (channel_id, None)
+        else:
+            replies.append(reply)
+
+    async def send_replies(self, channel: discord.Channel, replies: list):
+        """ Send replies recorded by a command's response cache. """
+        for reply in replies:
+            if reply.file is not None:
+                await self.send_file(channel, BytesIO(reply.file) if type(reply.file) is bytes else reply.file,
+                                     filename=reply.filename, content=reply.content, tts=reply.tts)
+            else:
+                # The content was already escaped when it was first sent
+                await self.send_message(channel, reply.content, embed=reply.embed, tts=reply.tts, allow_everyone=True)
+
     async def delete_message(self, message):
         """ Override to add info on the last deleted message. """
         self.last_deleted_messages = [message]
@@ -119,12 +283,73 @@ class Client(discord.Client):
         await super().delete_messages(messages)
 
     async def wait_for_message(self, timeout=None, *, author=None, channel=None, content=None, check=None, bot=False):
-        """ Override the check with the bot keyword: if bot=False, the function
-        won't accept messages from bot accounts, where if bot=True it doesn't care. """
-        def new_check(message: discord.Message):
-            return (check(message) if check is not None else True) and (True if bot else not message.author.bot)
+        """ Override to add the bot keyword: if bot=False, the function
+        won't accept messages from bot accounts, where if bot=True it doesn't care.
+
+        Waiters are indexed by channel and author, so that an incoming message only
+        evaluates the waiters that could accept it. """
+        def predicate(message: discord.Message):
+            if not bot and message.author.bot:
+                return False
+            if content is not None and not message.content.startswith(str(content)):
+                return False
 
-        return await super().wait_for_message(timeout, author=author, channel=channel, content=content, check=new_check)
+            return check(message) if callable(check) else True
+
+        channel_id = channel.id if channel is not None else None
+        author_id = author.id if author is not None else None
+        waiter = (predicate, asyncio.Future(loop=self.loop))
+        self.message_waiters.setdefault(channel_id, {}).setdefault(author_id, []).append(waiter)
+
+        try:
+            return await asyncio.wait_for(waiter[1], timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._remove_message_waiter(channel_id, author_id, waiter)
+
+    def _remove_message_waiter(self, channel_id: str, author_id: str, waiter: tuple):
+        """ Remove a waiter from the registry, along with any empty buckets. """
+        authors = self.message_waiters.get(channel_id)
+        if authors is None or author_id not in authors:
+            return
+
+        waiters = authors[author_id]
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            del authors[author_id]
+        if not authors:
+            del self.message_waiters[channel_id]
+
+    def handle_message(self, message: discord.Message):
+        """ Resolve the waiters registered for the message's channel and author,
+        and those registered without either. """
+        for channel_id in (message.channel.id, None):
+            authors = self.message_waiters.get(channel_id)
+            if not authors:
+                continue
+
+            for author_id in (message.author.id, None):
+                for predicate, future in list(authors.get(author_id, ())):
+                    # The waiter is removed once its wait_for_message call resumes
+                    if future.done():
+                        continue
+
+                    try:
+                        result = predicate(message)
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        if result:
+                            future.set_result(message)
+
+        super().handle_message(message)
+
+    @property
+    def pending_message_waiters(self):
+        """ The number of wait_for_message calls currently waiting. """
+        return sum(len(waiters) for authors in self.message_waiters.values() for waiters in authors.values())
 
     @staticmethod
     async def say(message: discord.Message, content: str):
@@ -146,31 +371,57 @@ async def autosave():
         logging.debug("Plugins saved")
 
 
-def log_message(message: discord.Message, prefix: str=""):
+def log_message(message: discord.Message, prefix: str="", command: plugins.Command=None):
     """ Logs a command/message. """
-    logging.info("{prefix}@{author}{server} -> {content}".format(
-        author=message.author,
-        content=message.content.split("\n")[0],
-        server=" ({})".format(message.server.name) if not message.channel.is_private else "",
-        prefix=prefix,)
-    )
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+
+    logging.info("%s@%s%s -> %s", prefix, message.author,
+                 " ({})".format(message.server.name) if not message.channel.is_private else "",
+                 message.content.partition("\n")[0],
+                 extra=dict(command=command.name if command else None,
+                            guild=message.server.id if not message.channel.is_private else None))
 
 
 async def execute_command(command: plugins.Command, message: discord.Message, *args, **kwargs):
     """ Execute a command and send any AttributeError exceptions. """
     app_info = await client.application_info()
+    start_time = datetime.utcnow()
+
+    # Replay the replies of a previous execution with the same arguments, or record them
+    cache_key, task = None, asyncio.Task.current_task(loop=client.loop)
+    if command.cache is not None:
+        cache_key = command.cache.make_key(message, args, kwargs)
+        replies = command.cache.get(cache_key) if cache_key is not None else None
+        if replies is not None:
+            await client.send_replies(message.channel, replies)
+            return
+
+        if cache_key is not None:
+            client.response_recorders[task] = (message.channel.id, [])
 
     try:
         await command.function(message, *args, **kwargs)
     except AssertionError as e:
         await client.say(message, str(e) or command.error or plugins.format_help(command, message.server))
     except:
-        logging.error(traceback.format_exc())
+        logging.exception("An error occurred while executing command %s", command.name)
         if plugins.is_owner(message.author) and config.owner_error:
             await client.say(message, utils.format_code(traceback.format_exc()))
         else:
             await client.say(message, "An error occurred while executing this command. If the error persists, "
                                        "please send a PM to {}.".format(app_info.owner))
+    else:
+        if cache_key is not None:
+            replies = client.response_recorders[task][1]
+            if replies:
+                command.cache.set(cache_key, replies, server=message.server)
+    finally:
+        client.response_recorders.pop(task, None)
+        latency = (datetime.utcnow() - start_time).total_seconds() * 1000
+        logging.debug("Command %s finished in %.3fms", command.name, latency,
+                      extra=dict(command=command.name, latency=latency,
+                                 guild=message.server.id if not message.channel.is_private else None))
 
 
 def default_self(anno, default, message: discord.Message):
@@ -423,7 +674,8 @@ async def on_message(message: discord.Message):
     message = copy(message)
 
     # We don't care about channels we can't write in as the bot usually sends feedback
-    if message.server and message.server.owner and not message.server.me.permissions_in(message.channel).send_messages:
+    if message.server and message.server.owner and \
+            not plugins.get_permissions(message.server.me, message.channel).send_messages:
         return
 
     # Don't accept commands from bot accounts
@@ -470,7 +722,7 @@ async def on_message(message: discord.Message):
         return
 
     # Log the command executed and execute said command
-    log_message(original_message)
+    log_message(original_message, command=parsed_command)
     client.loop.create_task(execute_command(parsed_command, original_message, *args, **kwargs))
 
     # Manually dispatch an event for when commands are requested
@@ -479,7 +731,8 @@ async def on_message(message: discord.Message):
     # Log time spent parsing the command
     stop_time = datetime.utcnow()
     time_elapsed = (stop_time - start_time).total_seconds() * 1000
-    logging.debug("Time spent parsing command: {elapsed:.6f}ms".format(elapsed=time_elapsed))
+    logging.debug("Time spent parsing command: %.6fms", time_elapsed,
+                  extra=dict(command=parsed_command.name, latency=time_elapsed))
 
 
 async def add_tasks():
@@ -489,11 +742,10 @@ async def add_tasks():
     logging.info("Setting up background tasks.")
 
     # Call any on_ready function in plugins
-    for plugin in plugins.all_values():
-        if hasattr(plugin, "on_ready"):
-            client.loop.create_task(plugin.on_ready())
+    for name in list(plugins.all_keys()):
+        plugins.start_plugin_tasks(name)
 
-    client.loop.create_task(autosave())
+    plugins.create_task(autosave(), name="autosave", plugin="bot")
 
 
 def main():
@@ -521,11 +773,16 @@ def main():
                         action="store_true")
 
     parser.add_argument("--log-file", "-o", help="File to log to. Prints to terminal if omitted.")
+    parser.add_argument("--log-format", help="Log as plain text lines or JSON lines.",
+                        choices=log.log_formats, default="text")
+    parser.add_argument("--log-max-bytes", help="Rotate the log file when it exceeds this size. Never rotates when 0.",
+                        type=int, default=0, metavar="BYTES")
+    parser.add_argument("--log-backups", help="Number of rotated log files to keep.", type=int, default=5, metavar="N")
     start_args = parser.parse_args()
 
     # Setup logger with level specified in start_args or logging.INFO
-    logging.basicConfig(filename=start_args.log_file, level=start_args.log_level,
-                        format="%(levelname)s %(asctime)s [%(module)s / %(name)s]: %(message)s")
+    log.setup(start_args.log_level, filename=start_args.log_file, log_format=start_args.log_format,
+              max_bytes=start_args.log_max_bytes, backups=start_args.log_backups)
 
     # Always keep the websockets.protocol logger at INFO as a minimum unless --enable-protocol-logging is set
     if not start_args.enable_protocol_logging:
@@ -3,16 +3,18 @@
 This script works just like any of the plugins in plugins/
 """
 
+import builtins
 import importlib
 import inspect
 import logging
 import random
+import types
 from datetime import datetime, timedelta
 
 import discord
 import asyncio
 
-from pcbot import utils, Config, Annotate, config
+from pcbot import utils, Config, Annotate, config, triggers
 import plugins
 client = plugins.client  # type: discord.Client
 
@@ -20,8 +22,10 @@ client = plugins.client  # type: discord.Client
 sub = asyncio.subprocess
 lambdas = Config("lambdas", data={})
 lambda_config = Config("lambda-config", data=dict(imports=[], blacklist=[]))
+triggers.set_triggers("builtin", literals=lambdas.data.keys())
 
 code_globals = {}
+lambda_code = {}  # trigger: code object of the compiled lambda_session function
 
 
 @plugins.command(name="help", aliases="commands")
@@ -44,19 +48,7 @@ async def help_(message: discord.Message, command: str.lower=None, *args):
 
     # Display every command
     else:
-        commands = []
-
-        for plugin in plugins.all_values():
-            # Only go through plugins with actual commands
-            if not getattr(plugin, "__commands", False):
-                continue
-
-            # Add all commands that the user can use
-            for cmd in plugin.__commands:
-                if not cmd.hidden and plugins.can_use_command(cmd, message.author, message.channel):
-                    commands.append(cmd.name_prefix(message.server).split()[0])
-
-        commands = ", ".join(sorted(commands))
+        commands = plugins.format_command_list(message.author, message.channel)
 
         m = "**Commands**: ```{0}```Use `{1}help <command>`, `{1}<command> {2}` or " \
             "`{1}<command> {3}` for command specific help.".format(
@@ -87,11 +79,19 @@ async def setowner(message: discord.Message):
         plugins.owner_cfg.save()
 
 
+shutdown_save_timeout = 30
+
+
 @plugins.command(owner=True)
 async def stop(message: discord.Message):
     """ Stops the bot. """
     await client.say(message, "\N{COLLISION SYMBOL}\N{PISTOL}")
-    await plugins.save_plugins()
+    await plugins.save_plugins(timeout=shutdown_save_timeout)
+
+    # Unload the plugins, so that they can stop their tasks and worker processes
+    for name in list(plugins.all_keys()):
+        plugins.unload_plugin(name)
+
     await client.logout()
 
 
@@ -266,6 +266,8 @@ async def add(message: discord.Message, trigger: str, python_code: Annotate.Code
     """ Add a command that runs the specified python code. """
     lambdas.data[trigger] = python_code
     lambdas.save()
+    lambda_code.pop(trigger, None)
+    triggers.set_triggers("builtin", literals=lambdas.data.keys())
     await client.say(message, "Command `{}` set.".format(trigger))
 
 
@@ -277,6 +279,8 @@ async def remove(message: discord.Message, trigger: str):
     # The command specified exists and we remove it
     del lambdas.data[trigger]
     lambdas.save()
+    lambda_code.pop(trigger, None)
+    triggers.set_triggers("builtin", literals=lambdas.data.keys())
     await client.say(message, "Command `{}` removed.".format(trigger))
 
 
@@ -435,10 +439,45 @@ async def changelog_(message: discord.Message, num: utils.int_range(f=1)=3):
     await client.say(message, await get_changelog(num))
 
 
+@bot_hub.command(owner=True)
+async def stats(message: discord.Message):
+    """ Display internal runtime statistics. """
+    caches = sorted(plugins.response_caches, key=lambda c: c.name or "")
+    caches = "\n".join("{0.name:<16}: {0.hits} hits, {0.misses} misses ({1:.0%}), {2} entries".format(
+        cache, cache.hit_rate, len(cache.entries)) for cache in caches)
+
+    tasks = []
+    for name in sorted(set(plugins.supervised_tasks) | set(plugins.task_exceptions)):
+        running = plugins.supervised_tasks[name].values()
+        oldest = min((t.started for t in running), default=None)
+        tasks.append("{:<16}: {} running, {} exceptions{}".format(
+            name, len(running), plugins.task_exceptions[name],
+            ", oldest started {}".format(oldest.diff_for_humans()) if oldest else ""))
+
+    saves = "\n".join("{:<16}: {:.3f}s{}".format(
+        name, duration, " (saving)" if name in plugins.saves_in_progress else "")
+        for name, duration in sorted(plugins.save_durations.items()))
+
+    await client.say(message, "```elm\n"
+                              "Pending message waiters : {waiters}\n"
+                              "Queued messages         : {queued}```"
+                              "**Response caches**```elm\n{caches}```"
+                              "**Tasks**```elm\n{tasks}```"
+                              "**Last plugin saves** ({dirty} unsaved)```elm\n{saves}```".format(
+        waiters=client.pending_message_waiters,
+        queued=client.queued_messages,
+        caches=caches or "None",
+        tasks="\n".join(tasks) or "None",
+        dirty=len(plugins.dirty_plugins),
+        saves=saves or "None"
+    ))
+
+
 @bot_hub.command(name="prefix", permissions="administrator", disabled_pm=True)
 async def set_prefix(message: discord.Message, prefix: str=None):
     """ Set the bot prefix. **The prefix is case sensitive and may not include spaces.** """
     config.set_server_config(message.server, "command_prefix", utils.split(prefix)[0] if prefix else None)
+    plugins.clear_help_cache()
 
     pre = config.default_command_prefix if prefix is None else prefix
     await client.say(message, "Set the server prefix to `{}`.".format(pre))
@@ -486,29 +525,46 @@ def init():
         lambda_config.save()
 
 
-@plugins.event()
-async def on_message(message: discord.Message):
+def compile_lambda(trigger: str):
+    """ Return the code object of a lambda's lambda_session function, compiling it only once.
+
+    :raises SyntaxError: The lambda's code is invalid.
+    """
+    if trigger not in lambda_code:
+        # Create an async function so that we can await it
+        python_code = "async def lambda_session():\n    " + "\n    ".join(lambdas.data[trigger].split("\n"))
+        namespace = {}
+        exec(compile(python_code, "<lambda {}>".format(trigger), "exec"), namespace)
+        lambda_code[trigger] = namespace["lambda_session"].__code__
+
+    return lambda_code[trigger]
+
+
+@plugins.event(pass_context=True, triggers="builtin")
+async def on_message(message: discord.Message, context: utils.MessageContext):
     """ Perform lambda commands. """
-    args = utils.split(message.content)
-    if not args:
+    # Look up the first word before tokenizing the message. Quoted triggers are only found in the arguments
+    words = context.content.split(None, 1)
+    if not words:
         return
 
+    trigger = words[0]
+    if trigger not in lambdas.data and trigger[0] in utils.split_quotes:
+        trigger = context.args[0] if context.args else None
+
     # Check if the command is a lambda command and is not disabled (in the blacklist)
-    if args[0] in lambdas.data and args[0] not in lambda_config.data["blacklist"]:
+    if trigger in lambdas.data and trigger not in lambda_config.data["blacklist"]:
+        # The arguments are shared with other listeners of the message, so lambdas get their own copy
+        args = list(context.args)
+
         def arg(i, default=0):
             if len(args) > i:
                 return args[i]
             else:
                 return default
 
-        code_globals.update(dict(arg=arg, args=args, message=message, client=client,
-                                 author=message.author, server=message.server, channel=message.channel))
-        python_code = lambdas.data[args[0]]
-
-        # Create an async function so that we can await it using the result of eval
-        python_code = "async def lambda_session():\n    " + "\n    ".join(line for line in python_code.split("\n"))
         try:
-            exec(python_code, code_globals)
+            code = compile_lambda(trigger)
         except SyntaxError as e:
             if plugins.is_owner(message.author):
                 await client.say(message, "```" + utils.format_syntax_error(e) + "```")
@@ -517,9 +573,14 @@ async def on_message(message: discord.Message):
                                 "\n{}".format(utils.format_syntax_error(e)))
             return True
 
+        # Every invocation gets its own globals, so that concurrent lambdas don't overwrite each other's
+        session_globals = dict(code_globals, __builtins__=builtins, arg=arg, args=args, message=message,
+                               client=client, author=message.author, server=message.server,
+                               channel=message.channel)
+
         # Execute the command
         try:
-            await eval("lambda_session()", code_globals)
+            await types.FunctionType(code, session_globals)()
         except AssertionError as e:  # Send assertion errors to the core module
             raise AssertionError(e)
         except Exception as e:
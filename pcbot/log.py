@@ -0,0 +1,78 @@
+""" Logging setup for PCBOT.
+
+Every record is put on a queue by the root logger and written by a
+background thread, so that formatting tracebacks and file I/O never
+blocks the event loop.
+"""
+
+import atexit
+import json
+import logging
+import queue
+from copy import copy
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+text_format = "%(levelname)s %(asctime)s [%(module)s / %(name)s]: %(message)s"
+log_formats = ("text", "json")
+
+# Optional fields which can be given to a record through the extra keyword, e.g:
+#   logging.info("...", extra=dict(command="help", guild="1234", latency=1.5))
+structured_fields = ("command", "guild", "latency")
+
+listener = None  # type: QueueListener
+
+
+class DeferredQueueHandler(QueueHandler):
+    """ Queue handler which merges the message arguments, but leaves any exception info
+    on the record so that the traceback is formatted by the listener thread. """
+    def prepare(self, record: logging.LogRecord):
+        record = copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    """ Format every record as a single line of JSON, including any structured
+    fields given to the record. """
+    def format(self, record: logging.LogRecord):
+        data = dict(time=self.formatTime(record), level=record.levelname, module=record.module,
+                    name=record.name, message=record.getMessage())
+
+        for field in structured_fields:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(data, default=str)
+
+
+def setup(level: int, filename: str=None, log_format: str="text", max_bytes: int=0, backups: int=0):
+    """ Setup the root logger and start the background listener.
+
+    :param level: The logging level of the root logger.
+    :param filename: File to log to. Logs to stderr when None.
+    :param log_format: Either text or json.
+    :param max_bytes: Rotate the log file when it would exceed this size. Never rotates when 0.
+    :param backups: The number of rotated log files to keep.
+    """
+    global listener
+
+    if filename is not None:
+        handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter() if log_format == "json" else logging.Formatter(text_format))
+
+    records = queue.Queue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(records))
+
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+
+    # Make sure every queued record is written before exiting
+    atexit.register(listener.stop)
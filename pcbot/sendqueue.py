@@ -0,0 +1,115 @@
+""" Outgoing message queues.
+
+Every channel has its own queue of messages, which are sent in order while
+keeping under Discord's message rate limit of the channel. A queue is done
+once it is empty and its sends no longer count towards the rate limit. Interactive
+replies to commands are sent before any queued background notifications,
+and consecutive short texts can be joined and sent as a single message when
+the caller allows it.
+"""
+
+import asyncio
+from collections import deque, namedtuple
+
+rate_limit = 5  # Messages sent per channel in every rate_limit_period
+rate_limit_period = 5  # Seconds
+max_message_length = 2000
+
+QueuedSend = namedtuple("QueuedSend", "send content coalesce future")
+
+
+class SendQueue:
+    """ Queue of outgoing messages to a single channel. """
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_done=None):
+        """ Setup an empty queue.
+
+        :param on_done: Function called with the queue when it is done, e.g. to remove it.
+        """
+        self.loop = loop
+        self.on_done = on_done
+        self.interactive = deque()
+        self.background = deque()
+        self.sent = deque(maxlen=rate_limit)  # Loop time of the most recent sends
+        self.worker = None  # type: asyncio.Task
+
+    def __len__(self):
+        return len(self.interactive) + len(self.background)
+
+    def put(self, send, content: str=None, background: bool=False, coalesce: bool=False):
+        """ Queue a message and return a future with the sent message.
+
+        :param send: Function which takes the content and returns a coroutine sending the message.
+        :param content: The content given to the send function.
+        :param background: Send after every queued interactive message.
+        :param coalesce: The content may be joined with other coalesced messages queued after it.
+        """
+        future = asyncio.Future(loop=self.loop)
+        queue = self.background if background else self.interactive
+        queue.append(QueuedSend(send, content, coalesce and content is not None, future))
+
+        if self.worker is None or self.worker.done():
+            self.worker = self.loop.create_task(self._send_queued())
+
+        return future
+
+    async def _wait_for_bucket(self):
+        """ Sleep until another message can be sent without hitting the rate limit. """
+        if len(self.sent) < rate_limit:
+            return
+
+        delay = self.sent[0] + rate_limit_period - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay, loop=self.loop)
+
+    def _next_batch(self):
+        """ Pop the next message to send, along with any messages that can be coalesced with it.
+        Messages that are no longer waited for are dropped. """
+        queue = self.interactive or self.background
+        batch = [queue.popleft()]
+
+        if batch[0].coalesce:
+            length = len(batch[0].content)
+            while queue and queue[0].coalesce and length + 1 + len(queue[0].content) <= max_message_length:
+                length += 1 + len(queue[0].content)
+                batch.append(queue.popleft())
+
+        return [queued for queued in batch if not queued.future.cancelled()]
+
+    async def _send_batch(self, batch: list):
+        """ Send a batch of queued messages as a single message. """
+        content = "\n".join(queued.content for queued in batch) if len(batch) > 1 else batch[0].content
+        self.sent.append(self.loop.time())
+
+        try:
+            message = await batch[0].send(content)
+        except asyncio.CancelledError:
+            for queued in batch:
+                queued.future.cancel()
+            raise
+        except Exception as e:
+            for queued in batch:
+                if not queued.future.done():
+                    queued.future.set_exception(e)
+        else:
+            # Every coalesced message is resolved with the single message that was sent
+            for queued in batch:
+                if not queued.future.done():
+                    queued.future.set_result(message)
+
+    async def _send_queued(self):
+        """ Send every queued message, and call on_done once the queue is done. """
+        while self.interactive or self.background:
+            await self._wait_for_bucket()
+
+            batch = self._next_batch()
+            if batch:
+                await self._send_batch(batch)
+
+            # Keep the queue until the last send no longer counts towards the rate limit
+            if not self.interactive and not self.background and self.sent:
+                delay = self.sent[-1] + rate_limit_period - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay, loop=self.loop)
+
+        if self.on_done is not None:
+            self.on_done(self)
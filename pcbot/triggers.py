@@ -0,0 +1,212 @@
+""" Single pass trigger scanning for message events.
+
+Plugins register the literal words or regex patterns that their message
+listeners react to under a group name, and mark the listener with
+plugins.event(triggers=group). Every message is scanned once for all
+registered triggers, and listeners are only dispatched when their group
+matched.
+
+Literal triggers are case insensitive. The literals of every group are kept
+in an Aho-Corasick automaton, which finds whether any of them occurs in one
+pass over the lowercase content, no matter how many literals there are. An
+automaton is only built again when the triggers of its group change. Literal
+triggers may also be set for a single author, e.g. for user defined aliases,
+and are then only scanned for in the author's messages.
+
+Regex triggers are combined into a single alternation which rejects most
+messages in one search; only when it matches are the groups' patterns
+searched individually.
+"""
+
+import logging
+import re
+from collections import defaultdict, deque
+
+literal_triggers = {}  # group: set of lowercase str
+pattern_triggers = {}  # group: list of compiled regex patterns
+author_triggers = defaultdict(dict)  # author_id: {group: set of lowercase str}
+
+_literal_matchers = {}  # group: LiteralMatcher, built when the group is first scanned after a change
+_author_matchers = defaultdict(dict)  # author_id: {group: LiteralMatcher}
+_pattern_scanner = None  # Compiled alternation of every regex pattern that can be combined
+_uncombined_groups = set()  # Groups with patterns that are always searched individually
+_dirty = True  # Whether the pattern scanner must be compiled again
+
+# Flags that can be scoped to a single pattern in the combined alternation
+_scoped_flags = ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x"))
+
+# Group references change meaning when a pattern is combined with others
+_group_reference = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+class LiteralMatcher:
+    """ Aho-Corasick automaton telling whether any of a set of literals occurs in a text. """
+    def __init__(self, literals):
+        self.goto = [{}]  # node: {character: node}
+        self.fail = [0]  # node: the node of the longest proper suffix which is in the automaton
+        self.output = [False]  # node: whether a literal ends here, or in any of its suffixes
+
+        for literal in literals:
+            node = 0
+            for char in literal:
+                if char not in self.goto[node]:
+                    self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                node = self.goto[node][char]
+
+            self.output[node] = True
+
+        # Link every node to its longest suffix, breadth first so that shorter suffixes are linked first
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+
+                suffix = self.fail[node]
+                while suffix and char not in self.goto[suffix]:
+                    suffix = self.fail[suffix]
+
+                self.fail[child] = self.goto[suffix].get(char, 0)
+                self.output[child] = self.output[child] or self.output[self.fail[child]]
+
+    def search(self, text: str):
+        """ Return True if any literal occurs in the text. """
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+
+            node = goto[node].get(char, 0)
+            if output[node]:
+                return True
+
+        return False
+
+
+def set_triggers(group: str, literals=(), patterns=()):
+    """ Set the triggers of a group, replacing any previously set triggers.
+
+    The group should be named after the plugin, so that its triggers are
+    removed when the plugin is reloaded or unloaded.
+
+    :param group: The group name, which listeners give as plugins.event(triggers=group).
+    :param literals: Iterable of str matched anywhere in the content, ignoring case.
+    :param patterns: Iterable of regex str or compiled patterns searched for in the content.
+    """
+    global _dirty
+    literal_triggers[group] = set(s.lower() for s in literals if s)
+    pattern_triggers[group] = [re.compile(p) if type(p) is str else p for p in patterns]
+    _literal_matchers.pop(group, None)
+    _dirty = True
+
+
+def set_author_triggers(group: str, author_id: str, literals=()):
+    """ Set the literal triggers of a group which only match messages by the given author,
+    replacing the author's previously set triggers in the group.
+
+    :param group: The group name, which listeners give as plugins.event(triggers=group).
+    :param author_id: The id of the author whose messages are scanned for the literals.
+    :param literals: Iterable of str matched anywhere in the content, ignoring case.
+    """
+    literals = set(s.lower() for s in literals if s)
+    if literals:
+        author_triggers[author_id][group] = literals
+    else:
+        author_triggers[author_id].pop(group, None)
+        if not author_triggers[author_id]:
+            del author_triggers[author_id]
+            _author_matchers.pop(author_id, None)
+
+    if author_id in _author_matchers:
+        _author_matchers[author_id].pop(group, None)
+
+
+def remove_triggers(group: str):
+    """ Remove every trigger in the group, including those set for single authors. """
+    global _dirty
+    if group in literal_triggers:
+        del literal_triggers[group]
+        del pattern_triggers[group]
+        _literal_matchers.pop(group, None)
+        _dirty = True
+
+    for author_id in [author_id for author_id, groups in author_triggers.items() if group in groups]:
+        set_author_triggers(group, author_id)
+
+
+def _scoped(pattern):
+    """ Return the pattern as a non-capturing group with its flags scoped to it. """
+    flags = "".join(letter for flag, letter in _scoped_flags if pattern.flags & flag)
+    return "(?{}:{})".format(flags, pattern.pattern) if flags else "(?:{})".format(pattern.pattern)
+
+
+def _build():
+    """ Compile the pattern scanner from the registered triggers. """
+    global _pattern_scanner, _uncombined_groups, _dirty
+
+    patterns, _uncombined_groups = [], set()
+    for group, group_patterns in pattern_triggers.items():
+        for pattern in group_patterns:
+            if _group_reference.search(pattern.pattern):
+                _uncombined_groups.add(group)
+            else:
+                patterns.append(pattern)
+
+    _pattern_scanner = None
+    if patterns:
+        try:
+            _pattern_scanner = re.compile("|".join(_scoped(p) for p in patterns))
+        except re.error:  # Patterns with conflicting group names can't be combined
+            logging.debug("Trigger patterns could not be combined; searching them individually")
+            _uncombined_groups = set(group for group, group_patterns in pattern_triggers.items() if group_patterns)
+
+    _dirty = False
+
+
+def _scan_literals(groups: dict, matchers: dict, lower_content: str, matched: set):
+    """ Add the groups with any of their literals in the content to matched, building
+    the matchers of groups that changed since they were last scanned. """
+    for group, literals in groups.items():
+        if group in matched or not literals:
+            continue
+
+        if group not in matchers:
+            matchers[group] = LiteralMatcher(literals)
+
+        if matchers[group].search(lower_content):
+            matched.add(group)
+
+
+def scan(content: str, lower_content: str=None, author_id: str=None):
+    """ Return the set of groups with triggers in the given content.
+
+    :param content: The message content.
+    :param lower_content: The message content in lowercase, if already computed.
+    :param author_id: The id of the message author, whose own literal triggers are also scanned for.
+    """
+    if _dirty:
+        _build()
+
+    matched = set()
+
+    if lower_content is None:
+        lower_content = content.lower()
+
+    _scan_literals(literal_triggers, _literal_matchers, lower_content, matched)
+    if author_id in author_triggers:
+        _scan_literals(author_triggers[author_id], _author_matchers[author_id], lower_content, matched)
+
+    # Search each group's patterns when the combined pattern matches, or when the patterns could not be combined
+    groups = _uncombined_groups
+    if _pattern_scanner is not None and _pattern_scanner.search(content):
+        groups = pattern_triggers.keys()
+
+    for group in groups:
+        if group not in matched and any(p.search(content) for p in pattern_triggers[group]):
+            matched.add(group)
+
+    return matched
@@ -7,6 +7,8 @@ command specific functions and helpers.
 import logging
 import re
 import shlex
+from bisect import bisect_left, insort
+from collections import defaultdict
 from enum import Enum
 from functools import wraps
 from io import BytesIO
@@ -261,6 +263,248 @@ def convert_image_object(image, format: str="PNG", **params):
     return buffer
 
 
+class NameIndex:
+    """ Index of objects by one or more lowercase names, used to look up members and
+    channels without lowercasing and scanning every object on every lookup.
+
+    Lookups follow the same steps as find_member and find_channel: exact name, name
+    starts with and name is in. When several objects match, the one indexed first wins.
+    """
+    ngram_size = 3
+
+    def __init__(self, get_names):
+        """ Setup an empty index.
+
+        :param get_names: function returning an iterable of names for an object.
+        """
+        self.get_names = get_names
+        self.objects = {}  # id: (order, object, names)
+        self.exact = defaultdict(set)  # name: {id, ...}
+        self.sorted_names = []  # Sorted list of (name, id) for prefix lookups
+        self.ngrams = defaultdict(set)  # ngram: {id, ...} for substring lookups
+        self._order = 0
+
+    def __len__(self):
+        return len(self.objects)
+
+    def _ngrams(self, name: str):
+        """ Return the set of ngrams in a name. """
+        return set(name[i:i + self.ngram_size] for i in range(len(name) - self.ngram_size + 1))
+
+    def _index(self, obj, order: int=None):
+        """ Index an object which is not already indexed, except for its sorted names.
+
+        :return: The lowercase names of the object.
+        """
+        if order is None:
+            order = self._order
+            self._order += 1
+
+        names = set(name.lower() for name in self.get_names(obj) if name)
+        self.objects[obj.id] = (order, obj, names)
+
+        for name in names:
+            self.exact[name].add(obj.id)
+            for i in range(len(name) - self.ngram_size + 1):
+                self.ngrams[name[i:i + self.ngram_size]].add(obj.id)
+
+        return names
+
+    def add(self, obj, order: int=None):
+        """ Add or replace an object in the index. """
+        if obj.id in self.objects:
+            order = self.remove(obj.id)
+
+        for name in self._index(obj, order):
+            insort(self.sorted_names, (name, obj.id))
+
+    def extend(self, objs):
+        """ Add every object which is not already indexed. The sorted names are sorted
+        once, which is much faster than inserting them one by one for large servers. """
+        for obj in objs:
+            if obj.id not in self.objects:
+                self.sorted_names.extend((name, obj.id) for name in self._index(obj))
+
+        self.sorted_names.sort()
+
+    def remove(self, obj_id: str):
+        """ Remove an object from the index and return its order, or None if it was not indexed. """
+        if obj_id not in self.objects:
+            return None
+
+        order, _, names = self.objects.pop(obj_id)
+        for name in names:
+            self.exact[name].discard(obj_id)
+            if not self.exact[name]:
+                del self.exact[name]
+
+            i = bisect_left(self.sorted_names, (name, obj_id))
+            if i < len(self.sorted_names) and self.sorted_names[i] == (name, obj_id):
+                del self.sorted_names[i]
+
+            for ngram in self._ngrams(name):
+                self.ngrams[ngram].discard(obj_id)
+                if not self.ngrams[ngram]:
+                    del self.ngrams[ngram]
+
+        return order
+
+    def update(self, obj):
+        """ Re-index an object whose names might have changed. """
+        if obj.id in self.objects and self.objects[obj.id][2] == set(n.lower() for n in self.get_names(obj) if n):
+            return
+
+        self.add(obj)
+
+    def _first(self, ids, predicate=None):
+        """ Return the first indexed object of the given ids, optionally filtered by a predicate. """
+        first = None
+        for obj_id in ids:
+            order, obj, names = self.objects[obj_id]
+            if predicate is not None and not predicate(names):
+                continue
+
+            if first is None or order < first[0]:
+                first = (order, obj)
+
+        return first[1] if first else None
+
+    def find(self, name: str, steps: int=3):
+        """ Find an object by name using the given number of steps.
+
+        :param name: The name to look for.
+        :param steps: int from 0-3 to specify search depth.
+        :return: The first matched object or None.
+        """
+        name = name.lower()
+
+        # Step 1: name is equal
+        if steps >= 1 and name in self.exact:
+            return self._first(self.exact[name])
+
+        # Step 2: name starts with
+        if steps >= 2:
+            ids = set()
+            i = bisect_left(self.sorted_names, (name, ""))
+            while i < len(self.sorted_names) and self.sorted_names[i][0].startswith(name):
+                ids.add(self.sorted_names[i][1])
+                i += 1
+
+            if ids:
+                return self._first(ids)
+
+        # Step 3: name is in, narrowed down by ngrams when the name is long enough
+        if steps >= 3:
+            if len(name) >= self.ngram_size:
+                ids = None
+                for ngram in self._ngrams(name):
+                    if ngram not in self.ngrams:
+                        return None
+
+                    ids = set(self.ngrams[ngram]) if ids is None else ids & self.ngrams[ngram]
+            else:
+                ids = self.objects.keys()
+
+            return self._first(ids, lambda names: any(name in n for n in names))
+
+        return None
+
+
+member_indexes = {}  # server_id: NameIndex
+
+
+def get_member_index(server: discord.Server):
+    """ Return the member index of a server, building it when missing or syncing it when out of sync. """
+    index = member_indexes.get(server.id)
+    if index is None:
+        index = member_indexes[server.id] = NameIndex(lambda m: (m.name, m.display_name))
+
+    # The member count differing means we missed an event, e.g members added while chunking
+    if not len(index) == len(server.members):
+        index.extend(server.members)
+
+        # Remove any members who left without us knowing
+        if len(index) > len(server.members):
+            member_ids = set(member.id for member in server.members)
+            for member_id in [member_id for member_id in index.objects if member_id not in member_ids]:
+                index.remove(member_id)
+
+    return index
+
+
+channel_indexes = {}  # server_id: {discord.ChannelType: NameIndex}
+nsfw_channels = {}  # server_id: discord.Channel or None
+
+
+def get_channel_index(server: discord.Server, channel_type: discord.ChannelType):
+    """ Return the channel index of a server for the given channel type, building
+    the server's indexes when missing or out of sync. """
+    indexes = channel_indexes.get(server.id)
+
+    if indexes is None or not sum(len(index) for index in indexes.values()) == len(server.channels):
+        indexes = defaultdict(lambda: NameIndex(lambda c: (c.name,)))
+        for channel in server.channels:
+            indexes[channel.type].add(channel)
+
+        channel_indexes[server.id] = indexes
+
+    return indexes[channel_type]
+
+
+def find_nsfw_channel(server: discord.Server):
+    """ Return the first channel with nsfw in its name, or None. The result is cached
+    until a channel in the server changes. """
+    if server.id not in nsfw_channels:
+        nsfw_channels[server.id] = discord.utils.find(lambda c: "nsfw" in c.name, server.channels)
+
+    return nsfw_channels[server.id]
+
+
+def _update_channel_index(channel: discord.Channel, removed: bool=False):
+    """ Add, update or remove a channel in its server's index. """
+    if channel.is_private:
+        return
+
+    nsfw_channels.pop(channel.server.id, None)
+    indexes = channel_indexes.get(channel.server.id)
+    if indexes is None:
+        return
+
+    # The channel type might have changed, so remove it from every partition
+    for index in indexes.values():
+        index.remove(channel.id)
+
+    if not removed:
+        indexes[channel.type].add(channel)
+
+
+def update_indexes(event: str, *args):
+    """ Keep the server indexes up to date. This should be called by the client
+    for every event dispatched. """
+    if event == "channel_create":
+        _update_channel_index(args[0])
+    elif event == "channel_delete":
+        _update_channel_index(args[0], removed=True)
+    elif event == "channel_update":
+        _update_channel_index(args[1])
+    elif event == "member_join":
+        member = args[0]
+        if member.server.id in member_indexes:
+            member_indexes[member.server.id].add(member)
+    elif event == "member_remove":
+        member = args[0]
+        if member.server.id in member_indexes:
+            member_indexes[member.server.id].remove(member.id)
+    elif event == "member_update":
+        member = args[1]
+        if member.server.id in member_indexes:
+            member_indexes[member.server.id].update(member)
+    elif event in ("server_remove", "server_join", "server_available"):
+        member_indexes.pop(args[0].id, None)
+        channel_indexes.pop(args[0].id, None)
+        nsfw_channels.pop(args[0].id, None)
+
+
 def find_member(server: discord.Server, name, steps=3, mention=True):
     """ Find any member by their name or a formatted mention.
     Steps define the depth at which to search. More steps equal
@@ -281,29 +525,14 @@ def find_member(server: discord.Server, name, steps=3, mention=True):
     :param mention: bool, check for mentions.
     :return: discord.Member
     """
-    member = None
-
     # Return a member from mention
     found_mention = member_mention_pattern.search(name)
     if found_mention and mention:
         member = server.get_member(found_mention.group("id"))
         return member
 
-    name = name.lower()
-
-    # Steps to check, higher values equal more fuzzy checks
-    checks = [lambda m: m.name.lower() == name or m.display_name.lower() == name,
-              lambda m: m.name.lower().startswith(name) or m.display_name.lower().startswith(name),
-              lambda m: name in m.display_name.lower() or name in m.name.lower()]
-
-    for i in range(steps if steps <= len(checks) else len(checks)):
-        member = discord.utils.find(checks[i], server.members)
-
-        if member:
-            break
-
-    # Return the found member or None
-    return member
+    # Look up the member in the server's name index
+    return get_member_index(server).find(name, steps)
 
 
 def find_channel(server: discord.Server, name, steps=3, mention=True, channel_type="text"):
@@ -343,17 +572,9 @@ def find_channel(server: discord.Server, name, steps=3, mention=True, channel_ty
     if found_mention and mention and channel_type is discord.ChannelType.text:
         channel = server.get_channel(found_mention.group("id"))
 
+    # Look up the channel in the server's name index for this channel type
     if not channel:
-        # Steps to check, higher values equal more fuzzy checks
-        checks = [lambda c: c.name.lower() == name.lower() and c.type is channel_type,
-                  lambda c: c.name.lower().startswith(name.lower()) and c.type is channel_type,
-                  lambda c: name.lower() in c.name.lower() and c.type is channel_type]
-
-        for i in range(steps if steps <= len(checks) else len(checks)):
-            channel = discord.utils.find(checks[i], server.channels)
-
-            if channel:
-                break
+        channel = get_channel_index(server, channel_type).find(name, steps)
 
     # Return the found channel or None
     return channel
@@ -485,6 +706,9 @@ def text_to_emoji(text: str):
     return "".join(chr(ord(c) + regional_offset) for c in text.upper())
 
 
+split_quotes = '"`'  # Characters grouping words in split
+
+
 def split(text: str, maxsplit: int=-1):
     """ Split a string with shlex when possible, and add support for maxsplit.
 
@@ -494,7 +718,7 @@ def split(text: str, maxsplit: int=-1):
     """
     # Generate a shlex object for eventually splitting manually
     split_object = shlex.shlex(text, posix=True)
-    split_object.quotes = '"`'
+    split_object.quotes = split_quotes
     split_object.whitespace_split = True
     split_object.commenters = ""
 
@@ -517,3 +741,61 @@ def split(text: str, maxsplit: int=-1):
     # Add any following text without splitting
     maxsplit_object.append(split_object.instream.read())
     return maxsplit_object
+
+
+class MessageContext:
+    """ Lazily derived forms of a message's content. One context is created for every
+    dispatched message and shared between the plugin listeners that ask for it, so
+    each form is computed at most once per message. """
+    def __init__(self, message: discord.Message):
+        self.message = message
+        self._args = None
+        self._lower_content = None
+        self._clean_content = None
+        self._mentions = None
+        self._urls = None
+
+    @property
+    def content(self):
+        """ The raw content of the message. """
+        return self.message.content
+
+    @property
+    def args(self):
+        """ The message content split with split(). """
+        if self._args is None:
+            self._args = split(self.message.content)
+
+        return self._args
+
+    @property
+    def lower_content(self):
+        """ The message content in lowercase. """
+        if self._lower_content is None:
+            self._lower_content = self.message.content.lower()
+
+        return self._lower_content
+
+    @property
+    def clean_content(self):
+        """ The message content with mentions converted to names. """
+        if self._clean_content is None:
+            self._clean_content = self.message.clean_content
+
+        return self._clean_content
+
+    @property
+    def mentions(self):
+        """ A set of the user ids mentioned in the message content. """
+        if self._mentions is None:
+            self._mentions = set(member_mention_pattern.findall(self.message.content))
+
+        return self._mentions
+
+    @property
+    def urls(self):
+        """ A list of every http or https url in the message content. """
+        if self._urls is None:
+            self._urls = [match.group(0) for match in http_url_pattern.finditer(self.message.content)]
+
+        return self._urls
@@ -1,24 +1,29 @@
 """ PCBOT's plugin handler.
 """
 
+import asyncio
 import importlib
 import os
 import logging
 import inspect
-from collections import namedtuple, defaultdict
+import time
+import weakref
+from collections import namedtuple, defaultdict, OrderedDict
+from enum import IntFlag
 from functools import partial
-from traceback import format_exc
 
 import discord
 import pendulum
 
-from pcbot import config, Annotate, identifier_prefix, format_exception
+from pcbot import config, triggers, Annotate, identifier_prefix, format_exception
 
 plugins = {}
 events = defaultdict(list)
 Command = namedtuple("Command", "name name_prefix aliases owner permissions roles servers "
                                 "usage description function parent sub_commands depth hidden error pos_check "
-                                "disabled_pm doc_args")
+                                "disabled_pm doc_args cache")
+Reply = namedtuple("Reply", "content embed tts file filename")
+SupervisedTask = namedtuple("SupervisedTask", "name plugin task started cancel_on_reload")
 lengthy_annotations = (Annotate.Content, Annotate.CleanContent, Annotate.LowerContent,
                        Annotate.LowerCleanContent, Annotate.Code)
 argument_format = "{open}{name}{suffix}{close}"
@@ -27,6 +32,24 @@ owner_cfg = config.Config("owner")
 CoolDown = namedtuple("CoolDown", "date command specific")
 cooldown_data = defaultdict(list)  # member: []
 
+# Computed permissions and role names, invalidated by update_permission_cache. The least recently used come first
+permission_cache = OrderedDict()  # (server_id, member_id): {channel_id: discord.Permissions}
+role_name_cache = OrderedDict()  # (server_id, member_id): frozenset of role names
+max_cached_members = 10000  # The number of members whose permissions and role names are cached
+
+# Rendered help and usage text, cleared whenever plugins are (re)loaded or a prefix changes
+help_cache = {}
+
+response_caches = weakref.WeakSet()  # Every ResponseCache, for displaying metrics
+
+supervised_tasks = defaultdict(dict)  # plugin name: {task name or id: SupervisedTask}
+task_exceptions = defaultdict(int)  # plugin name: number of exceptions raised by its tasks
+
+dirty_plugins = set()  # Names of plugins with unsaved changes
+saves_in_progress = {}  # plugin name: asyncio.Task
+save_durations = {}  # plugin name: seconds spent in the plugin's last save
+max_concurrent_saves = 4
+
 client = None  # The client. This variable holds the bot client and is to be used by plugins
 
 
@@ -88,6 +111,99 @@ def _format_usage(func, pos_check):
         return " ".join(usage)
 
 
+def _hashable(obj):
+    """ Convert lists, tuples and dicts to nested tuples so that the object can be used in a key. """
+    if isinstance(obj, (list, tuple)):
+        return tuple(_hashable(o) for o in obj)
+    elif isinstance(obj, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in obj.items()))
+
+    return obj
+
+
+class ResponseCache:
+    """ Least recently used cache of the replies sent by deterministic commands.
+
+    Give an instance as the cache option of a command to replay the recorded
+    replies when the command is executed with the same arguments. Replies are
+    only recorded when the command succeeds. The cache can also be used directly
+    with get() and set().
+    """
+    def __init__(self, ttl: float=None, maxsize: int=256, per_server: bool=False, key=None, name: str=None):
+        """ Create a response cache.
+
+        :param ttl: Seconds before an entry expires, or None to keep entries until evicted or invalidated.
+        :param maxsize: The maximum number of entries. The least recently used entry is evicted when full.
+        :param per_server: Key entries by the server the command was executed in.
+        :param key: Optional function taking the message and returning additional key components.
+        :param name: The name displayed in metrics. Defaults to the command name.
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.per_server = per_server
+        self.key = key
+        self.name = name
+        self.entries = OrderedDict()  # key: (expiry time or None, server id or None, value)
+        self.hits = 0
+        self.misses = 0
+        response_caches.add(self)
+
+    def make_key(self, message: discord.Message, args: tuple, kwargs: dict):
+        """ Return the key of a command executed with the given arguments, or None if
+        the arguments can't be used in a key. """
+        key = (_hashable(args), _hashable(kwargs),
+               message.server.id if self.per_server and message.server else None,
+               self.key(message) if self.key is not None else None)
+
+        try:
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
+
+    def get(self, key):
+        """ Return the cached value, or None if there is no valid entry. """
+        entry = self.entries.get(key)
+        if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+        if entry is not None:
+            del self.entries[key]
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value, server: discord.Server=None):
+        """ Cache a value, evicting the least recently used entry when full.
+
+        :param server: The server the value belongs to, so that it can be invalidated by server.
+        """
+        expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (expiry, server.id if server else None, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, server: discord.Server=None):
+        """ Remove every entry, or only the entries of the given server. """
+        if server is None:
+            self.entries.clear()
+            return
+
+        for key in [k for k, entry in self.entries.items() if entry[1] == server.id]:
+            del self.entries[key]
+
+    @property
+    def hit_rate(self):
+        """ The ratio of lookups which were hits. """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+
 def _parse_str_list(obj, name, cmd_name):
     """ Return the list from the parsed str or an empty list if object is None. """
     if type(obj) is str:
@@ -127,6 +243,8 @@ def command(**options):
         roles       : str / list  : Roles required for this command as a str separated by whitespace or a list.
         servers     : str / list  : a str separated by whitespace or a list of valid server ids.
         disabled_pm : bool        : Command is disabled in PMs when True.
+        cache       : bool / ResponseCache : Replay the replies of previous executions with the same arguments.
+                                    When True, a ResponseCache with the default options is used.
     """
     def decorator(func):
         # Make sure the first parameter in the function is a message object
@@ -151,6 +269,7 @@ def command(**options):
         permissions = options.get("permissions")
         roles = options.get("roles")
         servers = options.get("servers")
+        cache = options.get("cache")
 
         # Parse str lists
         aliases = _parse_str_list(aliases, "aliases", name)
@@ -158,6 +277,14 @@ def command(**options):
         roles = _parse_str_list(roles, "roles", name)
         servers = _parse_str_list(servers, "servers", name)
 
+        # Set the response cache
+        if cache is True:
+            cache = ResponseCache()
+        elif cache is False:
+            cache = None
+        if cache is not None and cache.name is None:
+            cache.name = name
+
         # Set the usage of this command
         usage_suffix = options.get("usage", _format_usage(func, pos_check))
 
@@ -216,7 +343,7 @@ def command(**options):
         cmd = Command(name=name, aliases=aliases, usage=usage, name_prefix=name_prefix, description=description,
                       function=func, parent=parent, sub_commands=[], depth=depth, hidden=hidden, error=error,
                       pos_check=pos_check, disabled_pm=disabled_pm, doc_args=doc_args, owner=owner,
-                      permissions=permissions, roles=roles, servers=servers)
+                      permissions=permissions, roles=roles, servers=servers, cache=cache)
 
         # If the command has a parent (is a subcommand)
         if parent:
@@ -233,15 +360,71 @@ def command(**options):
         # Add the cmd attribute to this function, in order to get the command assigned to the function
         setattr(func, "cmd", cmd)
 
-        logging.debug("Registered {} {} from plugin {}".format("subcommand" if parent else "command",
-                                                               name, plugin.__name__))
+        logging.debug("Registered %s %s from plugin %s", "subcommand" if parent else "command",
+                      name, plugin.__name__)
         return func
 
     return decorator
 
 
-def event(name=None, bot=False, self=False):
-    """ Decorator to add event listeners in plugins. """
+class MemberChange(IntFlag):
+    """ Flags for the fields that changed in a member_update event. """
+    username_changed = 1
+    nick_changed = 2
+    roles_changed = 4
+    avatar_changed = 8
+    status_changed = 16
+    game_changed = 32
+    streaming_started = 64
+    streaming_stopped = 128
+
+
+def is_streaming(member: discord.Member):
+    """ Return True if the member is streaming. """
+    return member.game is not None and member.game.type == 1
+
+
+def member_changes(before: discord.Member, after: discord.Member):
+    """ Return the MemberChange flags of a member_update event. """
+    changes = MemberChange(0)
+    if not before.name == after.name:
+        changes |= MemberChange.username_changed
+    if not before.nick == after.nick:
+        changes |= MemberChange.nick_changed
+    if not before.roles == after.roles:
+        changes |= MemberChange.roles_changed
+    if not before.avatar == after.avatar:
+        changes |= MemberChange.avatar_changed
+    if not before.status == after.status:
+        changes |= MemberChange.status_changed
+
+    # Games are compared by name only, so a game that starts streaming is checked separately
+    streaming_before, streaming_after = is_streaming(before), is_streaming(after)
+    if streaming_after and not streaming_before:
+        changes |= MemberChange.streaming_started
+    elif streaming_before and not streaming_after:
+        changes |= MemberChange.streaming_stopped
+
+    if not before.game == after.game or not streaming_before == streaming_after:
+        changes |= MemberChange.game_changed
+
+    return changes
+
+
+def event(name=None, bot=False, self=False, pass_context=False, triggers=None, changes: MemberChange=None):
+    """ Decorator to add event listeners in plugins.
+
+    :param name: The event name. Uses the function name by default.
+    :param bot: When True, the listener is also triggered by bot accounts.
+    :param self: When True, the listener is also triggered by the client itself.
+    :param pass_context: When True, the listener of a message event is given the shared
+        utils.MessageContext of the message as the context keyword argument.
+    :param triggers: The name of a trigger group set with triggers.set_triggers(). The listener of
+        a message event is then only called when the message matches one of the group's triggers.
+    :param changes: MemberChange flags. The listener of a member_update event is then only called
+        when one of the flagged fields changed. With pass_context, the listener is given the
+        MemberChange flags of the update as the context keyword argument.
+    """
     def decorator(func):
         event_name = name or func.__name__
 
@@ -257,6 +440,9 @@ def event(name=None, bot=False, self=False):
         # The self attribute denotes if own messages will be logged
         setattr(func, "bot", bot)
         setattr(func, "self", self)
+        setattr(func, "pass_context", pass_context)
+        setattr(func, "triggers", triggers)
+        setattr(func, "changes", changes)
 
         # Register our event
         events[event_name].append(func)
@@ -276,6 +462,11 @@ def argument(format=argument_format, *, pass_message=False, allow_spaces=False):
     return decorator
 
 
+def clear_help_cache():
+    """ Clear all rendered help and usage text. """
+    help_cache.clear()
+
+
 def format_usage(cmd: Command, server: discord.Server):
     """ Format the usage string of the given command. Places any usage
     of a sub command on a newline.
@@ -287,7 +478,12 @@ def format_usage(cmd: Command, server: discord.Server):
     if cmd.hidden and cmd.parent is not None:
         return
 
+    # The usage only depends on the server's command prefix
     command_prefix = config.server_command_prefix(server)
+    key = ("usage", id(cmd), command_prefix)
+    if key in help_cache:
+        return help_cache[key]
+
     usage = [cmd.usage(server)]
     for sub_command in cmd.sub_commands:
         # Recursively format the usage of the next sub commands
@@ -296,7 +492,8 @@ def format_usage(cmd: Command, server: discord.Server):
         if formatted:
             usage.append(formatted)
 
-    return "\n".join(s for s in usage if s is not None).format(pre=command_prefix) if usage else None
+    help_cache[key] = "\n".join(s for s in usage if s is not None).format(pre=command_prefix) if usage else None
+    return help_cache[key]
 
 
 def format_help(cmd: Command, server: discord.Server, no_subcommand: bool=False):
@@ -307,14 +504,19 @@ def format_help(cmd: Command, server: discord.Server, no_subcommand: bool=False)
     :param no_subcommand: Use only the given command's usage.
     :return: str: help message.
     """
+    command_prefix = config.server_command_prefix(server)
+    key = ("help", id(cmd), command_prefix, no_subcommand)
+    if key in help_cache:
+        return help_cache[key]
+
     usage = cmd.usage(server) if no_subcommand else format_usage(cmd, server)
 
     # If there is no usage, the command isn't supposed to be displayed as such
     # Therefore, we switch to using the parent command instead
     if usage is None and cmd.parent is not None:
-        return format_help(cmd.parent, server)
+        help_cache[key] = format_help(cmd.parent, server)
+        return help_cache[key]
 
-    command_prefix = config.server_command_prefix(server)
     desc = cmd.description.format(pre=command_prefix)
 
     # Format aliases
@@ -328,7 +530,63 @@ def format_help(cmd: Command, server: discord.Server, no_subcommand: bool=False)
             ", ".join((command_prefix if identifier_prefix.match(alias[0]) and cmd.parent is None else "") +
                       alias for alias in cmd.aliases))
 
-    return "**Usage**: ```{}```**Description**: {}{}".format(usage, desc, alias_format)
+    help_cache[key] = "**Usage**: ```{}```**Description**: {}{}".format(usage, desc, alias_format)
+    return help_cache[key]
+
+
+def _command_requirements():
+    """ Return the permissions and roles required by any listed command, and whether
+    any listed command is restricted to specific servers. """
+    if "requirements" not in help_cache:
+        permissions, roles, servers = set(), set(), False
+        for plugin in all_values():
+            for cmd in getattr(plugin, "__commands", []):
+                if cmd.hidden:
+                    continue
+
+                permissions.update(cmd.permissions)
+                roles.update(cmd.roles)
+                servers = servers or bool(cmd.servers)
+
+        help_cache["requirements"] = (permissions, frozenset(roles), servers)
+
+    return help_cache["requirements"]
+
+
+def _permission_fingerprint(author, channel: discord.Channel):
+    """ Return a hashable summary of everything can_use_command checks for the
+    commands listed in help. Authors with equal fingerprints see the same commands. """
+    permissions, roles, servers = _command_requirements()
+    member_perms = get_permissions(author, channel) if permissions else None
+
+    return (is_owner(author), type(author),
+            author.server.id if servers and type(author) is discord.Member else None,
+            frozenset(perm for perm in permissions if getattr(member_perms, perm, False)),
+            get_role_names(author) & roles if roles else None)
+
+
+def format_command_list(author, channel: discord.Channel):
+    """ Return a sorted and comma separated str of every command the author
+    can use in the given channel.
+
+    :param author: The discord.Member or discord.User to list commands for.
+    :param channel: The channel the commands would be used in.
+    :return: str: formatted command names.
+    """
+    server = None if channel.is_private else channel.server
+    key = ("commands", config.server_command_prefix(server), _permission_fingerprint(author, channel))
+    if key in help_cache:
+        return help_cache[key]
+
+    commands = []
+    for plugin in all_values():
+        # Add all commands that the user can use
+        for cmd in getattr(plugin, "__commands", []):
+            if not cmd.hidden and can_use_command(cmd, author, channel):
+                commands.append(cmd.name_prefix(server).split()[0])
+
+    help_cache[key] = ", ".join(sorted(commands))
+    return help_cache[key]
 
 
 def parent_attr(cmd: Command, attr: str):
@@ -406,12 +664,85 @@ def is_owner(user: discord.User):
     return False
 
 
+def get_permissions(member: discord.Member, channel: discord.Channel):
+    """ Return the member's permissions in the channel, computing them only when
+    they are not already cached. """
+    if channel.is_private:
+        return member.permissions_in(channel)
+
+    member_cache = _get_cached(permission_cache, (channel.server.id, member.id), dict)
+    if channel.id not in member_cache:
+        member_cache[channel.id] = member.permissions_in(channel)
+
+    return member_cache[channel.id]
+
+
+def get_role_names(member: discord.Member):
+    """ Return a frozenset of the member's role names, excluding @everyone. """
+    if not isinstance(member, discord.Member):
+        return frozenset()
+
+    return _get_cached(role_name_cache, (member.server.id, member.id),
+                       lambda: frozenset(r.name for r in member.roles[1:]))
+
+
+def _get_cached(cache: OrderedDict, key: tuple, create):
+    """ Return the value of a key in one of the member caches, creating it when missing
+    and evicting the least recently used members when the cache is full. """
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    value = cache[key] = create()
+    while len(cache) > max_cached_members:
+        cache.popitem(last=False)
+
+    return value
+
+
+def _forget_member(server_id: str, member_id: str):
+    """ Remove any cached permissions and role names of a member. """
+    permission_cache.pop((server_id, member_id), None)
+    role_name_cache.pop((server_id, member_id), None)
+
+
+def _forget_server(server_id: str):
+    """ Remove any cached permissions and role names of every member in a server. """
+    for cache in (permission_cache, role_name_cache):
+        for key in [key for key in cache if key[0] == server_id]:
+            del cache[key]
+
+
+def update_permission_cache(event: str, *args):
+    """ Invalidate cached permissions affected by the given event. This should be
+    called by the client for every event dispatched. """
+    if event in ("server_role_create", "server_role_delete", "server_role_update"):
+        _forget_server(args[0].server.id)
+    elif event in ("server_update", "server_remove"):
+        _forget_server(args[0].id)
+    elif event == "member_update":
+        before, after = args
+        if not before.roles == after.roles:
+            _forget_member(after.server.id, after.id)
+    elif event == "member_remove":
+        _forget_member(args[0].server.id, args[0].id)
+    elif event in ("channel_update", "channel_delete"):
+        channel = args[-1]
+        if channel.is_private:
+            return
+
+        # Channel overwrites affect every member's permissions in the channel
+        for (server_id, _), member_cache in permission_cache.items():
+            if server_id == channel.server.id:
+                member_cache.pop(channel.id, None)
+
+
 def has_permissions(cmd: Command, author: discord.Member, channel: discord.Channel):
     """ Return True if the member has permissions to execute the command. """
     if not cmd.permissions:
         return True
 
-    member_perms = author.permissions_in(channel)
+    member_perms = get_permissions(author, channel)
     if all(getattr(member_perms, perm, False) for perm in cmd.permissions):
         return True
 
@@ -424,7 +755,7 @@ def has_roles(cmd: Command, author: discord.Member):
     if not cmd.roles:
         return True
 
-    member_roles = [r.name for r in author.roles[1:]]
+    member_roles = get_role_names(author)
     if any(r in member_roles for r in cmd.roles):
         return True
 
@@ -495,6 +826,65 @@ def get_cooldown(member: discord.Member, cmd: Command):
         return None
 
 
+def _task_done(key, supervised: SupervisedTask, task):
+    """ Remove a finished task from the supervisor and log any exception it raised. """
+    if supervised_tasks[supervised.plugin].get(key) is supervised:
+        del supervised_tasks[supervised.plugin][key]
+
+    if not task.cancelled() and task.exception() is not None:
+        task_exceptions[supervised.plugin] += 1
+        logging.error("Task %s of plugin %s raised an exception", supervised.name, supervised.plugin,
+                      exc_info=task.exception())
+
+
+def create_task(coro, name: str=None, plugin: str=None, cancel_on_reload: bool=True):
+    """ Create a task owned by a plugin. Use this rather than client.loop.create_task
+    for any task started by a plugin.
+
+    Any exception raised by the task is logged and counted. When the task is given a
+    name and a task with the same name is already running in the plugin, the coroutine
+    is closed and the running task is returned instead, so that background loops are
+    never started twice.
+
+    :param coro: The coroutine to run.
+    :param name: An optional name of the task, unique in the plugin.
+    :param plugin: The name of the plugin owning the task. Defaults to the caller's module.
+    :param cancel_on_reload: Cancel the task when the plugin is reloaded or unloaded.
+    :return: asyncio.Task
+    """
+    if plugin is None:
+        plugin = inspect.currentframe().f_back.f_globals["__name__"].split(".")[-1]
+
+    running = supervised_tasks[plugin].get(name) if name is not None else None
+    if running is not None:
+        coro.close()
+        return running.task
+
+    task = client.loop.create_task(coro)
+    key = name if name is not None else id(task)
+    supervised = SupervisedTask(name=name or getattr(coro, "__qualname__", "task"), plugin=plugin, task=task,
+                                started=pendulum.now(), cancel_on_reload=cancel_on_reload)
+    supervised_tasks[plugin][key] = supervised
+    task.add_done_callback(partial(_task_done, key, supervised))
+    return task
+
+
+def cancel_tasks(plugin: str):
+    """ Cancel every task of the plugin which is cancelled on reload, and reset its exception count. """
+    task_exceptions.pop(plugin, None)
+    for key, supervised in list(supervised_tasks[plugin].items()):
+        if supervised.cancel_on_reload:
+            supervised.task.cancel()
+            del supervised_tasks[plugin][key]
+
+
+def start_plugin_tasks(name: str):
+    """ Start the plugin's on_ready coroutine as a supervised task, if it has one. """
+    plugin = get_plugin(name)
+    if plugin is not None and callable(getattr(plugin, "on_ready", None)):
+        create_task(plugin.on_ready(), name="on_ready", plugin=name)
+
+
 def load_plugin(name: str, package: str="plugins"):
     """ Load a plugin with the name name. If package isn't specified, this
     looks for plugin with specified name in /plugins/
@@ -505,14 +895,15 @@ def load_plugin(name: str, package: str="plugins"):
         try:
             plugin = importlib.import_module("{package}.{plugin}".format(plugin=name, package=package))
         except ImportError as e:
-            logging.error("An error occurred when loading plugin {}:\n{}".format(name, format_exception(e)))
+            logging.error("An error occurred when loading plugin %s:\n%s", name, format_exception(e))
             return False
         except:
-            logging.error("An error occurred when loading plugin {}:\n{}".format(name, format_exc()))
+            logging.exception("An error occurred when loading plugin %s", name)
             return False
 
         plugins[name] = plugin
-        logging.debug("LOADED PLUGIN " + name)
+        clear_help_cache()
+        logging.debug("LOADED PLUGIN %s", name)
         return True
 
     return False
@@ -534,15 +925,23 @@ async def reload(name: str):
         if hasattr(plugins[name], "__commands"):
             delattr(plugins[name], "__commands")
 
-        # Remove all registered events from the given plugin
+        # Remove all registered events and message triggers from the given plugin
         for event_name, funcs in events.items():
             for func in funcs:
                 if func.__module__.endswith(name):
                     events[event_name].remove(func)
+        triggers.remove_triggers(name)
+
+        # Stop the plugin's tasks, so that the reloaded plugin can start them again
+        cancel_tasks(name)
 
         plugins[name] = importlib.reload(plugins[name])
+        clear_help_cache()
 
-        logging.debug("Reloaded plugin {}".format(name))
+        if client.is_logged_in:
+            start_plugin_tasks(name)
+
+        logging.debug("Reloaded plugin %s", name)
 
 
 async def call_reload(name: str):
@@ -558,10 +957,20 @@ async def call_reload(name: str):
 
 
 def unload_plugin(name: str):
-    """ Unload a plugin by removing it from the plugin dictionary. """
+    """ Unload a plugin by removing it from the plugin dictionary. The plugin's
+    on_unload function is called first, if it has one. """
     if name in plugins:
+        if callable(getattr(plugins[name], "on_unload", None)):
+            try:
+                plugins[name].on_unload()
+            except:
+                logging.exception("An error occurred when unloading plugin %s", name)
+
         del plugins[name]
-        logging.debug("Unloaded plugin {}".format(name))
+        triggers.remove_triggers(name)
+        cancel_tasks(name)
+        clear_help_cache()
+        logging.debug("Unloaded plugin %s", name)
 
 
 def load_plugins():
@@ -576,24 +985,72 @@ def load_plugins():
             load_plugin(name)
 
 
+def mark_dirty(name: str=None):
+    """ Mark a plugin as having unsaved changes, so that its save function is
+    called on the next save. Only plugins marked dirty are saved.
+
+    :param name: The plugin name. Defaults to the caller's module.
+    """
+    if name is None:
+        name = inspect.currentframe().f_back.f_globals["__name__"].split(".")[-1]
+
+    dirty_plugins.add(name)
+
+
+async def _save(name: str, plugin):
+    """ Call the plugin's save function and record the time spent. """
+    started = time.monotonic()
+    try:
+        await plugin.save(plugins)
+    except:
+        dirty_plugins.add(name)
+        logging.exception("An error occurred when saving plugin %s", name)
+    finally:
+        save_durations[name] = time.monotonic() - started
+        del saves_in_progress[name]
+
+
 async def save_plugin(name):
-    """ Save a plugin's files if it has a save function. """
-    if name in all_keys():
-        plugin = get_plugin(name)
+    """ Save a plugin's files if it has a save function and unsaved changes.
+    Any save of the plugin already in progress is waited for rather than started twice. """
+    while name in saves_in_progress:
+        await asyncio.shield(saves_in_progress[name])
 
-        if callable(getattr(plugin, "save", False)):
-            try:
-                await plugin.save(plugins)
-            except:
-                logging.error("An error occurred when saving plugin {}:\n{}".format(name, format_exc()))
+    plugin = get_plugin(name)
+    if name not in dirty_plugins or not callable(getattr(plugin, "save", False)):
+        return
+
+    dirty_plugins.discard(name)
+    saves_in_progress[name] = client.loop.create_task(_save(name, plugin))
 
+    # The save is shielded, so that it completes even if the caller stops waiting for it
+    await asyncio.shield(saves_in_progress[name])
 
-async def save_plugins():
-    """ Looks for any save function in a plugin and saves.
-    Set up for saving on !stop and periodic saving every 30 minutes.
+
+async def save_plugins(timeout: float=None):
+    """ Concurrently save every plugin with unsaved changes, with at most max_concurrent_saves
+    saves running at once. Set up for saving on !stop and periodic saving every 30 minutes.
+
+    :param timeout: Seconds to wait for the saves, including saves already in progress.
+        Saves that do not finish in time keep running.
+    :return: True if every save finished.
     """
-    for name in all_keys():
-        await save_plugin(name)
+    names = dirty_plugins | set(saves_in_progress)
+    if not names:
+        return True
+
+    semaphore = asyncio.Semaphore(max_concurrent_saves)
+
+    async def bounded_save(name):
+        async with semaphore:
+            await save_plugin(name)
+
+    done, pending = await asyncio.wait([bounded_save(name) for name in names], timeout=timeout)
+    if pending:
+        logging.warning("%d plugin saves did not finish within %s seconds", len(pending), timeout)
+        return False
+
+    return True
 
 
 @argument(format="{open}on | off{close}")
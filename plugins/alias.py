@@ -6,7 +6,7 @@ alias
 import discord
 import asyncio
 
-from pcbot import Config, Annotate, config, utils
+from pcbot import Config, Annotate, config, utils, triggers
 import plugins
 client = plugins.client  # type: discord.Client
 
@@ -22,6 +22,15 @@ alias_desc = \
 aliases = Config("user_alias", data={})
 
 
+def update_triggers(member_id: str):
+    """ Set the message triggers to the member's aliases, which are only scanned for in their own messages. """
+    triggers.set_author_triggers("alias", member_id, literals=aliases.data.get(member_id, {}).keys())
+
+
+for alias_member_id in aliases.data:
+    update_triggers(alias_member_id)
+
+
 @plugins.command(description=alias_desc, pos_check=lambda s: s.startswith("-"))
 async def alias(message: discord.Message, *options: str.lower, trigger: str, text: Annotate.Content):
     """ Assign an alias. Description is defined in alias_desc. """
@@ -40,6 +49,7 @@ async def alias(message: discord.Message, *options: str.lower, trigger: str, tex
         delete_message=delete_message
     )
     aliases.save()
+    update_triggers(message.author.id)
 
     m = "**Alias assigned.** Type `{}`{} to trigger the alias."
     await client.say(message, m.format(trigger, " anywhere in a message" if anywhere else ""))
@@ -61,6 +71,7 @@ async def remove(message: discord.Message, trigger: Annotate.Content):
     if trigger == "*":
         aliases.data[message.author.id] = {}
         aliases.save()
+        update_triggers(message.author.id)
         await client.say(message, "**Removed all aliases.**")
 
     # Check if the trigger is in the would be list (basically checks if trigger is in [] if user is not registered)
@@ -70,11 +81,12 @@ async def remove(message: discord.Message, trigger: Annotate.Content):
     # Trigger is an assigned alias, remove it
     aliases.data[message.author.id].pop(trigger)
     aliases.save()
+    update_triggers(message.author.id)
     await client.say(message, "**Alias `{}` removed.**".format(trigger, message.author))
 
 
-@plugins.event()
-async def on_message(message: discord.Message):
+@plugins.event(pass_context=True, triggers="alias")
+async def on_message(message: discord.Message, context: utils.MessageContext):
     success = False
 
     # User alias check
@@ -84,17 +96,14 @@ async def on_message(message: discord.Message):
         # Check any aliases
         for name, command in user_aliases.items():
             execute = False
-            msg = message.content
-            args = utils.split(msg)
-
-            if not command.get("case_sensitive", False):
-                msg = msg.lower()
+            args = context.args
+            msg = context.content if command.get("case_sensitive", False) else context.lower_content
 
             if command.get("anywhere", False):
                 if name in msg:
                     execute = True
             else:
-                if name == args[0]:
+                if args and name == args[0]:
                     execute = True
 
             if execute:
@@ -11,7 +11,7 @@ from collections import namedtuple
 import discord
 
 import plugins
-from pcbot import Config
+from pcbot import Config, utils, triggers
 
 client = plugins.client  # type: discord.Client
 
@@ -141,7 +141,7 @@ async def delete_message(message: discord.Message, response: str, pattern: str):
         await client.send_message(message.channel, response)
 
 
-async def on_message(message: discord.Message):
+async def on_message(message: discord.Message, context: utils.MessageContext):
     """ Handle any message accordingly to the data in the blacklist config. """
     # We don't care about private channels
     if message.channel.is_private:
@@ -159,17 +159,18 @@ async def on_message(message: discord.Message):
 
     # Check for matching patterns
     if channel_config.match_patterns:
+        content = context.content if channel_config.case_sensitive else context.lower_content
+        words = None
+
         for pattern in channel_config.match_patterns:
-            content = message.content if channel_config.case_sensitive else message.content.lower()
             invalid = False
 
             # Look for whole words if the words field is set to True
             # This is ignored if the pattern has any spaces
             if channel_config.words and " " not in pattern:
-                for word in content.split(" "):
-                    if word == pattern:
-                        invalid = True
-                        break
+                if words is None:
+                    words = set(content.split(" "))
+                invalid = pattern in words
             else:
                 invalid = pattern in content
 
@@ -185,6 +186,21 @@ async def on_message(message: discord.Message):
                 return
 
 
+def all_sections():
+    """ Yield the config data of every section in the blacklist. """
+    yield blacklist.data["global"]
+    yield from blacklist.data["server"]
+    yield from blacklist.data["channel"]
+
+
 # Manually add the event if blacklists are enabled
 if blacklist.data["enabled"]:
-    plugins.event(bot=True)(on_message)
+    # The listener is only called for messages that match a pattern in any section. Matching is always
+    # case insensitive here, and the section specific rules are then checked by the listener
+    triggers.set_triggers(
+        "blacklist",
+        literals=(s for section in all_sections() for s in section.get("match_patterns", [])),
+        patterns=(re.compile(s, flags=re.IGNORECASE) for section in all_sections()
+                  for s in section.get("regex_patterns", []))
+    )
+    plugins.event(bot=True, pass_context=True, triggers="blacklist")(on_message)
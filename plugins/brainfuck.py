@@ -184,7 +184,7 @@ def assert_exists(name: str):
 def assert_author(name: str, member: discord.Member):
     """ Make sure that whoever is modifying a brainfuck entry
     is the author of said entry. """
-    author = discord.utils.get(client.get_all_members(), id=cfg.data[name]["author"])
+    author = client.get_any_member(cfg.data[name]["author"])
     assert author == member, "You are not the author of this entry. **({})**".format(author or "Unknown author")
 
 
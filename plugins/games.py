@@ -52,16 +52,17 @@ class Game:
             reply = await client.wait_for_message(timeout=120, channel=self.channel, check=check)
 
             if reply:  # A user replied with a valid check
-                asyncio.ensure_future(
+                plugins.create_task(
                     client.say(self.message,
                                     "{} has entered! `{}/{}`. Type `I` to join!".format(
-                                        reply.author.mention, i + 1, self.num))
+                                        reply.author.mention, i + 1, self.num)),
+                    cancel_on_reload=False
                 )
                 self.participants.append(reply.author)
 
                 # Remove the message if bot has permissions
                 if self.member.permissions_in(self.channel).manage_messages:
-                    asyncio.ensure_future(client.delete_message(reply))
+                    plugins.create_task(client.delete_message(reply), cancel_on_reload=False)
             else:
                 # At this point we got no reply in time and thus, gathering participants failed
                 await client.say(self.message, "**The {} game failed to gather {} participants.**".format(
@@ -187,9 +188,10 @@ class HotPotato(Game):
                 member = reply.mentions[0]
                 pass_to = []
                 if self.member.permissions_in(self.channel).manage_messages:
-                    asyncio.ensure_future(client.delete_message(reply))
+                    plugins.create_task(client.delete_message(reply), cancel_on_reload=False)
             elif self.time_remaining == notify:
-                asyncio.ensure_future(client.send_message(self.channel, ":bomb: :fire: **IT'S GONNA BLOW!**"))
+                plugins.create_task(client.send_message(self.channel, ":bomb: :fire: **IT'S GONNA BLOW!**"),
+                                    cancel_on_reload=False)
                 self.time_remaining -= 1
 
         await client.send_message(self.channel, "{0.mention} :fire: :boom: :boom: :fire:".format(member))
@@ -256,7 +258,7 @@ class Typing(Game):
                 return
 
             # Delete the member's reply in order to avoid cheating
-            asyncio.ensure_future(client.delete_message(reply))
+            plugins.create_task(client.delete_message(reply), cancel_on_reload=False)
             now = datetime.now()
 
             # Calculate the time elapsed since the game started
@@ -266,7 +268,7 @@ class Typing(Game):
             accuracy = self.calculate_accuracy(reply.clean_content)
             wpm = self.calculate_wpm(time_elapsed)
             m = self.reply.format(member=reply.author, time=time_elapsed, wpm=wpm, accuracy=accuracy)
-            asyncio.ensure_future(client.send_message(self.channel, m))
+            plugins.create_task(client.send_message(self.channel, m), cancel_on_reload=False)
 
             # Reduce the timeout by the current time elapsed and create a checkpoint for the next timeout calculation
             timeout -= int((now - checkpoint).total_seconds())
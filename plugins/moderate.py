@@ -19,7 +19,7 @@ from collections import defaultdict
 import discord
 import asyncio
 
-from pcbot import Config, utils, Annotate
+from pcbot import Config, utils, triggers, Annotate
 import plugins
 client = plugins.client  # type: discord.Client
 
@@ -168,8 +168,13 @@ async def timeout(message: discord.Message, member: discord.Member, minutes: flo
             message.author.mention, member.mention, minutes, reason
         ))
 
-    # Sleep for the given hours and unmute the member
-    await asyncio.sleep(minutes * 60)  # Since asyncio.sleep takes seconds, multiply by 60^2
+    # Unmute the member after the given minutes. This is kept running when the plugin reloads
+    plugins.create_task(unmute_after(message, muted_members, minutes), cancel_on_reload=False)
+
+
+async def unmute_after(message: discord.Message, muted_members: list, minutes: float):
+    """ Sleep for the given minutes and unmute the members. """
+    await asyncio.sleep(minutes * 60)  # Since asyncio.sleep takes seconds, multiply by 60
     await manage_mute(message, client.remove_roles, *muted_members)
 
 
@@ -238,7 +243,7 @@ async def purge(message: discord.Message, *instances: members_and_channels, num:
     await client.delete_messages([m, message])
 
 
-async def check_nsfw(message: discord.Message):
+async def check_nsfw(message: discord.Message, context: utils.MessageContext):
     """ Check if the message is NSFW (very rough check). """
     # Check if this server has nsfwfilter enabled
     if not moderate.data[message.server.id]["nsfwfilter"]:
@@ -249,12 +254,12 @@ async def check_nsfw(message: discord.Message):
         return False
 
     # Check if message includes keyword nsfw and a link
-    msg = message.content.lower()
+    msg = context.lower_content
     if "nsfw" in msg and ("http://" in msg or "https://" in msg):
         if message.server.me.permissions_in(message.channel).manage_messages:
             await client.delete_message(message)
 
-        nsfw_channel = discord.utils.find(lambda c: "nsfw" in c.name, message.server.channels)
+        nsfw_channel = utils.find_nsfw_channel(message.server)
 
         if nsfw_channel:
             await client.say(message, "{0.mention}: **Please post NSFW content in {1.mention}**".format(
@@ -263,8 +268,11 @@ async def check_nsfw(message: discord.Message):
         return True
 
 
-@plugins.event()
-async def on_message(message: discord.Message):
+triggers.set_triggers("moderate", literals=["nsfw"])
+
+
+@plugins.event(pass_context=True, triggers="moderate")
+async def on_message(message: discord.Message, context: utils.MessageContext):
     """ Check plugin settings. """
     # Do not check in private messages
     if message.channel.is_private:
@@ -272,7 +280,7 @@ async def on_message(message: discord.Message):
 
     setup_default_config(message.server)
 
-    nsfw_success = await check_nsfw(message)
+    nsfw_success = await check_nsfw(message, context)
     if nsfw_success is True:
         return True
 
@@ -296,7 +304,7 @@ def get_changelog_channel(server: discord.Server):
 
 async def log_change(channel: discord.Channel, message: str):
     embed = discord.Embed(description=message)
-    await client.send_message(channel, embed=embed)
+    await client.send_message(channel, embed=embed, background=True)
 
 
 @plugins.event()
@@ -401,12 +409,16 @@ async def on_member_remove(member: discord.Member):
     await log_change(changelog_channel, "{0.mention} ({0.name}) left the server.".format(member))
 
 
-@plugins.event()
-async def on_member_update(before: discord.Member, after: discord.Member):
+changelog_member_changes = (plugins.MemberChange.username_changed | plugins.MemberChange.nick_changed |
+                            plugins.MemberChange.roles_changed)
+
+
+@plugins.event(pass_context=True, changes=changelog_member_changes)
+async def on_member_update(before: discord.Member, after: discord.Member, context: plugins.MemberChange):
     """ Update the changelog with any changed names and roles. """
-    name_change = not before.name == after.name
-    nick_change = not before.nick == after.nick
-    role_change = not before.roles == after.roles
+    name_change = bool(context & plugins.MemberChange.username_changed)
+    nick_change = bool(context & plugins.MemberChange.nick_changed)
+    role_change = bool(context & plugins.MemberChange.roles_changed)
 
     changelog_channel = get_changelog_channel(after.server)
     if not changelog_channel:
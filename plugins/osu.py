@@ -28,9 +28,10 @@ Commands:
     pp
 """
 
+import heapq
 import logging
 import re
-import traceback
+from collections import namedtuple
 from datetime import datetime, timedelta
 from enum import Enum
 from typing import List
@@ -39,8 +40,8 @@ import aiohttp
 import asyncio
 import discord
 import plugins
-from pcbot import Config, utils, Annotate
-from plugins.osulib import api, Mods, calculate_pp, can_calc_pp, ClosestPPStats
+from pcbot import Config, utils, Annotate, triggers
+from plugins.osulib import api, Mods, calculate_pp, calculate_pp_batch, can_calc_pp, ClosestPPStats, shutdown_executor
 from plugins.twitchlib import twitch
 
 import json
@@ -55,7 +56,10 @@ osu_config = Config("osu", pretty=True, data=dict(
     minimum_pp_required=0,  # The minimum pp required to assign a gamemode/profile in general
     use_mentions_in_scores=True,  # Whether the bot will mention people when they set a *score*
     update_interval=30,  # The sleep time in seconds between updates
+    max_concurrent_requests=8,  # The maximum number of members updated at once
+    api_requests_per_minute=1200,  # The osu! API quota shared by every request
     not_playing_skip=10,  # Number of rounds between every time someone not playing is updated
+    max_poll_interval=60 * 30,  # The maximum time in seconds between polls of an inactive member
     map_event_repeat_interval=6,  # The time in hours before a map event will be treated as "new"
     profiles={},  # Profile setup as member_id: osu_id
     mode={},  # Member's game mode as member_id: gamemode_value
@@ -68,23 +72,38 @@ osu_config = Config("osu", pretty=True, data=dict(
 osu_tracking = {}  # Saves the requested data or deletes whenever the user stops playing (for comparisons)
 update_interval = osu_config.data.get("update_interval", 30)
 not_playing_skip = osu_config.data.get("not_playing_skip", 10)
+max_concurrent_requests = osu_config.data.get("max_concurrent_requests", 8)
+max_poll_interval = osu_config.data.get("max_poll_interval", 60 * 30)
+poll_backoff = 2  # The factor the poll interval of inactive members grows by
+poll_budget_share = 0.5  # The share of the API quota used for polling members, leaving the rest for scores and commands
+poll_schedule = []  # Heap of (loop time of the next poll, member_id)
 time_elapsed = 0  # The registered time it takes to process all information between updates (changes each update)
+last_poll = dict(duration=0, requests=0, updated=0, skipped=0, failed=0)  # Statistics of the last update_user_data
 logging_interval = 30  # The time it takes before posting logging information to the console. TODO: setup logging
 rank_regex = re.compile(r"#\d+")
 
 pp_threshold = osu_config.data.get("pp_threshold", 0.13)
 score_request_limit = osu_config.data.get("score_request_limit", 100)
+recent_request_limit = 10  # The number of recent plays checked for a new score
+new_score_lookups = dict(recent=0, best=0)  # The number of new scores looked up by recent plays and by top plays
 minimum_pp_required = osu_config.data.get("minimum_pp_required", 0)
 use_mentions_in_scores = osu_config.data.get("use_mentions_in_scores", True)
 max_diff_length = 21  # The maximum amount of characters in a beatmap difficulty
 
 api.set_api_key(osu_config.data.get("key"))
+api.set_quota(osu_config.data.get("api_requests_per_minute", 1200))
 host = "https://osu.ppy.sh/"
 rankings_url = "https://osu.ppy.sh/rankings/osu/performance"
 
 gamemodes = ", ".join(gm.name for gm in api.GameMode)
 
 recent_map_events = []
+map_event_jobs = {}  # beatmapset_id: MapEventJob
+map_event_delay = 45  # Seconds to wait before requesting the beatmapset of a map event
+map_event_retry_delay = 60  # Seconds between requests when the beatmapset was not found
+map_event_tries = 6  # The number of times the beatmapset of a map event is requested
+NotifyRoute = namedtuple("NotifyRoute", "member score_channels map_channels is_primary")
+notify_routes = {}  # member_id: list of NotifyRoute, built when first needed and cleared by invalidate_notify_routes()
 event_repeat_interval = osu_config.data.get("map_event_repeat_interval", 6)
 timestamp_pattern = re.compile(r"(\d+:\d+:\d+\s(\([0-9,]+\))?\s*)-")
 
@@ -198,7 +217,7 @@ async def format_stream(member: discord.Member, score: dict, beatmap: dict):
         vod_request = await twitch.request("channels/{}/videos".format(twitch_id), limit=1, broadcast_type="archive", sort="time")
         assert vod_request["_total"] >= 1
     except:
-        logging.error(traceback.format_exc())
+        logging.exception("Failed to find a twitch VOD for the score")
         return text + "\n"
 
     vod = vod_request["videos"][0]
@@ -316,90 +335,254 @@ def is_playing(member: discord.Member):
     return getattr(member.game, "name", None) and ("osu" in member.game.name.lower() or rank_regex.search(member.game.name))
 
 
-async def update_user_data():
-    """ Go through all registered members playing osu!, and update their data. """
-    global osu_tracking
-
-    # Go through each member playing and give them an "old" and a "new" subsection
-    # for their previous and latest user data
-    for member_id, profile in osu_config.data["profiles"].items():
-        # Skip members who disabled tracking
-        if get_update_mode(member_id) is UpdateModes.Disabled:
-            continue
+async def update_member_data(member_id: str, profile: str, semaphore: asyncio.Semaphore, stats: dict):
+    """ Update the data of a single registered member, counting the result in stats,
+    and schedule the member's next poll. """
+    data = osu_tracking[member_id]
 
-        member = discord.utils.get(client.get_all_members(), id=member_id)
-        if member is None:
-            continue
-     
-        # Add the member to tracking
-        if member_id not in osu_tracking:
-            osu_tracking[member_id] = dict(member=member, ticks=-1)
-
-        osu_tracking[member_id]["ticks"] += 1
-
-        # Only update members not tracked ingame every nth update
-        if not is_playing(member) and osu_tracking[member_id]["ticks"] % not_playing_skip > 0:
-            # Update their old data to match their new one in order to avoid duplicate posts
-            if "new" in osu_tracking[member_id]:
-                osu_tracking[member_id]["old"] = osu_tracking[member_id]["new"]
-            continue
-        
-        # Get the user data for the player
-        mode = get_mode(member_id).value
+    # Get the user data for the player. The API quota itself is shared through api.quota
+    mode = get_mode(member_id).value
+    async with semaphore:
         try:
             user_data = await api.get_user(u=profile, type="id", m=mode)
         except aiohttp.ServerDisconnectedError:
-            continue
+            user_data = None
         except asyncio.TimeoutError:
-            logging.warning("Timed out when retrieving osu! info from {} ({})".format(member, profile))
-            continue
-
-        # Sleep after using get_user as to not put too much strain on the API at once
-        await asyncio.sleep(.2)
+            logging.warning("Timed out when retrieving osu! info from %s (%s)", data["member"], profile)
+            user_data = None
 
         # Just in case something goes wrong, we skip this member (these things are usually one-time occurrences)
         if user_data is None:
-            logging.info("Could not retrieve osu! info from {} ({})".format(member, profile))
+            logging.info("Could not retrieve osu! info from %s (%s)", data["member"], profile)
+            stats["failed"] += 1
+            schedule_poll(member_id, next_poll_interval(data, active=False))
+            return
+
+        # If this is the first time, update the user's list of scores for later
+        if "new" not in data:
+            set_top_scores(member_id, await api.get_user_best(u=profile, type="id", limit=score_request_limit,
+                                                             m=mode) or [])
+
+    # Update the "new" data
+    active = "new" in data and is_active(data["new"], user_data)
+    data["new"] = user_data
+    data["new"]["ripple"] = True if api.ripple_pattern.match(profile) else False
+    stats["updated"] += 1
+
+    schedule_poll(member_id, next_poll_interval(data, active))
+
+
+def is_active(old: dict, new: dict):
+    """ Return True if the user played or had any events between two polls. """
+    return any(not old.get(key) == new.get(key) for key in ("playcount", "pp_raw", "events"))
+
+
+def next_poll_interval(data: dict, active: bool):
+    """ Return the seconds until a tracked member should be polled again.
+
+    Active members are polled every update, while the interval of inactive members
+    backs off exponentially. Members not playing start at not_playing_skip updates.
+    """
+    if active:
+        return update_interval
+
+    base_interval = update_interval if is_playing(data["member"]) else update_interval * not_playing_skip
+    return min(max(data.get("interval", 0) * poll_backoff, base_interval), max_poll_interval)
+
+
+def schedule_poll(member_id: str, interval: float):
+    """ Schedule the next poll of a tracked member. Any earlier scheduled poll is discarded. """
+    # The member might have stopped being tracked while they were polled
+    data = osu_tracking.get(member_id)
+    if data is None:
+        return
+
+    data["interval"] = interval
+    data["next_poll"] = client.loop.time() + interval
+    heapq.heappush(poll_schedule, (data["next_poll"], member_id))
+
+
+def poll_budget():
+    """ Return the maximum number of members polled in one update, which is a
+    share of the API quota for the update interval. """
+    return max(1, int(api.requests_per_minute / 60 * update_interval * poll_budget_share))
+
+
+def pop_due_members():
+    """ Pop the members due for a poll from the schedule, at most poll_budget() of them.
+    The members that have waited the longest are popped first. """
+    now, budget = client.loop.time(), poll_budget()
+    due = []
+
+    # Drop the polls of untracked and rescheduled members once they outnumber the tracked members
+    if len(poll_schedule) > 2 * len(osu_tracking):
+        poll_schedule[:] = [(next_poll, member_id) for next_poll, member_id in poll_schedule
+                            if member_id in osu_tracking and osu_tracking[member_id].get("next_poll") == next_poll]
+        heapq.heapify(poll_schedule)
+
+    while poll_schedule and poll_schedule[0][0] <= now and len(due) < budget:
+        next_poll, member_id = heapq.heappop(poll_schedule)
+
+        # Skip polls that were rescheduled, and members that are no longer tracked
+        data = osu_tracking.get(member_id)
+        if data is None or not data.get("next_poll") == next_poll:
+            continue
+        if member_id not in osu_config.data["profiles"] or get_update_mode(member_id) is UpdateModes.Disabled:
+            del osu_tracking[member_id]
             continue
 
-        # User is already tracked
-        if "new" in osu_tracking[member_id]:
-            # Move the "new" data into the "old" data of this user
-            osu_tracking[member_id]["old"] = osu_tracking[member_id]["new"]
-        else:
-            # If this is the first time, update the user's list of scores for later
-            osu_tracking[member_id]["scores"] = await api.get_user_best(u=profile, type="id", limit=score_request_limit, m=mode)
+        due.append(member_id)
+
+    return due
+
+
+async def update_user_data():
+    """ Go through all registered members, and update the data of those due for a poll.
+    At most max_concurrent_requests members are requested at once. """
+    global last_poll
+
+    started = datetime.now()
+    requests_sent = api.requests_sent
+    stats = dict(updated=0, skipped=0, failed=0)
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    # Add new members to tracking, and poll them right away
+    for member_id in osu_config.data["profiles"]:
+        if member_id in osu_tracking or get_update_mode(member_id) is UpdateModes.Disabled:
+            continue
+
+        member = client.get_any_member(member_id)
+        if member is not None:
+            osu_tracking[member_id] = dict(member=member)
+            schedule_poll(member_id, 0)
+
+    # Members that are not polled keep their data, so move the "new" data into the "old" data of every member
+    for data in osu_tracking.values():
+        if "new" in data:
+            data["old"] = data["new"]
+
+    due = pop_due_members()
+    stats["skipped"] = len(osu_tracking) - len(due)
+    profiles = osu_config.data["profiles"]
+    await asyncio.gather(*(update_member_data(member_id, profiles[member_id], semaphore, stats)
+                           for member_id in due))
+
+    last_poll = dict(stats, duration=(datetime.now() - started).total_seconds(),
+                     requests=api.requests_sent - requests_sent)
+    logging.debug("Updated osu! data in %.3f seconds: %s", last_poll["duration"], last_poll)
+
+
+@plugins.event(changes=plugins.MemberChange.game_changed)
+async def on_member_update(before: discord.Member, after: discord.Member):
+    """ Poll tracked members as soon as they start playing osu!. """
+    if after.id in osu_tracking and is_playing(after) and not is_playing(before):
+        schedule_poll(after.id, 0)
+
+
+def score_key(score: dict):
+    """ Return the key identifying a score among a user's top plays. """
+    return score["beatmap_id"], score["enabled_mods"], score["date"]
+
+
+def set_top_scores(member_id: str, scores: list):
+    """ Store a member's top plays along with the set of their keys. """
+    osu_tracking[member_id]["scores"] = scores
+    osu_tracking[member_id]["score_keys"] = set(score_key(score) for score in scores)
+
+
+def format_new_score_position(scores: list, i: int):
+    """ Return the score at index i of the top plays with its position and the difference
+    in pp from the score below. """
+    score = scores[i]
+    if i + 1 < len(scores):
+        diff = float(score["pp"]) - float(scores[i + 1]["pp"])
+    else:
+        diff = 0
+
+    return dict(score, pos=i + 1, diff=diff)
 
-        # Update the "new" data
-        osu_tracking[member_id]["new"] = user_data
-        osu_tracking[member_id]["new"]["ripple"] = True if api.ripple_pattern.match(profile) else False
+
+async def get_recent_top_score(member_id: str, profile: str, mode: int):
+    """ Return the user's newest unknown pass as a top play score, or None if the pass
+    is not their best score on the beatmap. """
+    recent_scores = await api.get_user_recent(u=profile, type="id", m=mode, limit=recent_request_limit)
+    if not recent_scores:
+        return None
+
+    # Find the newest pass which is not among the top plays already
+    score_keys = osu_tracking[member_id]["score_keys"]
+    play = next((s for s in recent_scores if not s["rank"] == "F" and score_key(s) not in score_keys), None)
+    if play is None:
+        return None
+
+    # The user's best score on the beatmap with these mods has the pp of the play, if it is the same play
+    scores = await api.get_scores(b=play["beatmap_id"], u=profile, type="id", m=mode, mods=play["enabled_mods"],
+                                  limit=1)
+    if not scores or not scores[0]["date"] == play["date"] or scores[0].get("pp") is None:
+        return None
+
+    return dict(scores[0], beatmap_id=play["beatmap_id"], enabled_mods=play["enabled_mods"])
+
+
+def insert_top_score(member_id: str, score: dict):
+    """ Insert a new score into a member's top plays, replacing any score on the same beatmap.
+    Only one score per beatmap is counted, so a score with other mods than the stored score on
+    the beatmap only replaces it when it is worth more pp.
+
+    :return: The index of the score, or None when the score is not among the top plays.
+    """
+    scores = osu_tracking[member_id]["scores"]
+    previous = next((s for s in scores if s["beatmap_id"] == score["beatmap_id"]), None)
+    if previous is not None and not float(score["pp"]) > float(previous["pp"]):
+        return None
+
+    scores = [s for s in scores if s is not previous]
+    i = sum(1 for s in scores if float(s["pp"]) > float(score["pp"]))
+    if i >= score_request_limit:
+        return None
+
+    scores.insert(i, score)
+    set_top_scores(member_id, scores[:score_request_limit])
+    return i
 
 
 async def get_new_score(member_id: str):
     """ Compare old user scores with new user scores and return the discovered
     new score if there is any. When a score is returned, it's position in the
-    player's top plays can be retrieved with score["pos"]. """
-    # Download a list of the user's scores
+    player's top plays can be retrieved with score["pos"].
+
+    The user's recent plays are checked first, and the top plays are only
+    downloaded when the new score was not found among them. """
     profile = osu_config.data["profiles"][member_id]
-    user_scores = await api.get_user_best(u=profile, type="id", limit=score_request_limit, m=get_mode(member_id).value,
-                                          request_tries=3)
+    mode = get_mode(member_id).value
+
+    # Members tracked before a reload may only have their list of scores
+    if "score_keys" not in osu_tracking[member_id]:
+        set_top_scores(member_id, osu_tracking[member_id].get("scores", []))
+
+    score = await get_recent_top_score(member_id, profile, mode)
+    if score is not None:
+        i = insert_top_score(member_id, score)
+        if i is not None:
+            new_score_lookups["recent"] += 1
+            return format_new_score_position(osu_tracking[member_id]["scores"], i)
+
+    # Download a list of the user's scores
+    new_score_lookups["best"] += 1
+    user_scores = await api.get_user_best(u=profile, type="id", limit=score_request_limit, m=mode, request_tries=3)
+    if not user_scores:
+        return None
 
     # Compare the scores from top to bottom and try to find a new one
+    score_keys = osu_tracking[member_id]["score_keys"]
     for i, score in enumerate(user_scores):
-        if score not in osu_tracking[member_id]["scores"]:
+        if score_key(score) not in score_keys:
             if i == 0:
-                logging.info(f"a #1 score was set: check plugins.osu.osu_tracking['{member_id}']['debug']")
+                logging.info("a #1 score was set: check plugins.osu.osu_tracking['%s']['debug']", member_id)
                 osu_tracking[member_id]["debug"] = dict(scores=user_scores, old=dict(osu_tracking[member_id]["old"]), new=dict(osu_tracking[member_id]["new"]))
-            osu_tracking[member_id]["scores"] = user_scores
-
-            # Calculate the difference in pp from the score below
-            if i < len(osu_tracking[member_id]["scores"]) - 2:
-                pp = float(score["pp"])
-                diff = pp - float(user_scores[i + 1]["pp"])
-            else:
-                diff = 0
+            set_top_scores(member_id, user_scores)
 
-            return dict(score, pos=i + 1, diff=diff)
+            return format_new_score_position(user_scores, i)
     else:
         return None
 
@@ -421,38 +604,106 @@ def get_notify_channels(server: discord.Server, data_type: str):
             if server.get_channel(s)]
 
 
-async def get_potential_pp(score, beatmap, member: discord.Member, score_pp: float, use_acc: bool=False):
-    """ Returns the potential pp or None if it shouldn't display """
-    potential_pp = None
+def get_notify_routes(member_id: str):
+    """ Return a list of NotifyRoute for every server a member's notifications are sent to. """
+    if member_id not in notify_routes:
+        primary_server = get_primary_server(member_id)
+        routes = []
+
+        for member in client.get_memberships(member_id):
+            score_channels = get_notify_channels(member.server, "score") or []
+            map_channels = get_notify_channels(member.server, "map") or []
+            if not score_channels and not map_channels:
+                continue
+
+            is_primary = primary_server is None or primary_server == member.server.id
+            routes.append(NotifyRoute(member, score_channels, map_channels, is_primary))
+
+        notify_routes[member_id] = routes
+
+    return notify_routes[member_id]
+
+
+def invalidate_notify_routes():
+    """ Clear the notification routes, which are then rebuilt from the current config and memberships. """
+    notify_routes.clear()
+
+
+@plugins.event(name="on_member_join")
+@plugins.event(name="on_member_remove")
+@plugins.event(name="on_server_join")
+@plugins.event(name="on_server_remove")
+@plugins.event(name="on_server_available")
+@plugins.event(name="on_server_unavailable")
+@plugins.event(name="on_channel_delete")
+async def update_notify_routes(*_):
+    """ Rebuild the notification routes when members, servers or channels change. """
+    invalidate_notify_routes()
 
+
+async def send_notification(channel: discord.Channel, embed: discord.Embed, mention: discord.Member=None):
+    """ Send a notification, and optionally mention a member and delete the mention right after.
+
+    :return: The sent message, or None when the bot is not allowed to send messages in the channel.
+    """
+    try:
+        msg = await client.send_message(channel, embed=embed, background=True)
+
+        if mention:
+            mention_msg = await client.send_message(channel, mention.mention, background=True)
+            await client.delete_message(mention_msg)
+    except discord.Forbidden:
+        return None
+
+    return msg
+
+
+def get_potential_pp_options(score, beatmap, member: discord.Member, use_acc: bool=False):
+    """ Returns the calculate_pp options of the score as a full combo, or None if the potential
+    pp shouldn't display. """
     # Find the potentially gained pp in standard when not FC
-    if get_mode(member.id) is api.GameMode.Standard and get_update_mode(member.id) is not UpdateModes.PP \
-            and int(score["maxcombo"]) < int(beatmap["max_combo"]):
-        options = ["+" + Mods.format_mods(int(score["enabled_mods"]))]
+    if not get_mode(member.id) is api.GameMode.Standard or get_update_mode(member.id) is UpdateModes.PP \
+            or int(score["maxcombo"]) >= int(beatmap["max_combo"]):
+        return None
 
-        if use_acc:
-            options.append("{acc:.2%}".format(acc=calculate_acc(api.GameMode.Standard, score, exclude_misses=True)))
-        else:
-            options.append(score["count100"] + "x100")
-            options.append(score["count50"] + "x50")
+    options = ["+" + Mods.format_mods(int(score["enabled_mods"]))]
 
-        try:
-            pp_stats = await calculate_pp("https://osu.ppy.sh/b/{}".format(score["beatmap_id"]), *options)
-            potential_pp = pp_stats.pp
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            pass
+    if use_acc:
+        options.append("{acc:.2%}".format(acc=calculate_acc(api.GameMode.Standard, score, exclude_misses=True)))
+    else:
+        options.append(score["count100"] + "x100")
+        options.append(score["count50"] + "x50")
 
-        # Drop this info whenever the potential pp gain is negative.
-        #     The osu! API does not provide info on sliderbreak count and missed sliderend count, which results
-        #     in faulty calculation (very often negative relatively). Therefore, I will conclude that the score
-        #     was actually an FC and has missed sliderends when the gain is negative.
-        if potential_pp - score_pp <= 0:
-            potential_pp = None
+    return options
+
+
+def filter_potential_pp(potential_pp: float, score_pp: float):
+    """ Returns the potential pp or None if it shouldn't display """
+    # Drop this info whenever the potential pp gain is negative.
+    #     The osu! API does not provide info on sliderbreak count and missed sliderend count, which results
+    #     in faulty calculation (very often negative relatively). Therefore, I will conclude that the score
+    #     was actually an FC and has missed sliderends when the gain is negative.
+    if potential_pp - score_pp <= 0:
+        return None
 
     return potential_pp
 
 
+async def get_potential_pp(score, beatmap, member: discord.Member, score_pp: float, use_acc: bool=False):
+    """ Returns the potential pp or None if it shouldn't display """
+    options = get_potential_pp_options(score, beatmap, member, use_acc)
+    if options is None:
+        return None
+
+    try:
+        pp_stats = await calculate_pp("https://osu.ppy.sh/b/{}".format(score["beatmap_id"]), *options)
+    except Exception:
+        logging.exception("Failed to calculate potential pp")
+        return None
+
+    return filter_potential_pp(pp_stats.pp, score_pp)
+
+
 def get_score_name(member: discord.Member, username: str, ripple=False):
     """ Formats the username and link for scores."""
     user_url = get_user_url(member.id)
@@ -522,19 +773,15 @@ async def notify_pp(member_id: str, data: dict):
     # Always add the difference in pp along with the ranks
     m += format_user_diff(mode, pp_diff, rank_diff, country_rank_diff, accuracy_diff, old["country"], new)
 
-    # Send the message to all servers
-    for server in client.servers:
-        member = server.get_member(member_id)
-        channels = get_notify_channels(server, "score")
-        if not member or not channels:
+    # Send the message to all servers at once, formatting the embed once for every server
+    sends = []
+    for route in get_notify_routes(member_id):
+        if not route.score_channels:
             continue
 
-        primary_server = get_primary_server(member.id)
-        is_primary = True if primary_server is None else (True if primary_server == server.id else False)
-
         # Format the url and the username
-        name = get_score_name(member, new["username"], "ripple" in data)
-        embed = get_formatted_score_embed(member, score, m, potential_pp)
+        name = get_score_name(route.member, new["username"], "ripple" in data)
+        embed = get_formatted_score_embed(route.member, score, m, potential_pp)
 
         # The top line of the format will differ depending on whether we found a score or not
         if score:
@@ -542,17 +789,13 @@ async def notify_pp(member_id: str, data: dict):
         else:
             embed.description = name + "\n" + m
 
-        for i, channel in enumerate(channels):
-            try:
-                await client.send_message(channel, embed=embed)
+        # In the primary server and if the user sets a score, send a mention and delete it
+        # This will only mention in the first channel of the server
+        mention = route.member if use_mentions_in_scores and score and route.is_primary else None
+        sends.extend(send_notification(channel, embed, mention if i == 0 else None)
+                     for i, channel in enumerate(route.score_channels))
 
-                # In the primary server and if the user sets a score, send a mention and delete it
-                # This will only mention in the first channel of the server
-                if use_mentions_in_scores and score and i == 0 and is_primary:
-                    mention = await client.send_message(channel, member.mention)
-                    await client.delete_message(mention)
-            except discord.Forbidden:
-                pass
+    await asyncio.gather(*sends)
 
 
 def format_beatmapset_diffs(beatmapset: list):
@@ -606,17 +849,17 @@ async def calculate_pp_for_beatmapset(beatmapset: list):
 
     cached_mapset = osu_config.data["map_cache"][set_id]
 
-    for i, diff in enumerate(beatmapset):
+    async def calculate_diff(i: int, diff: dict):
         map_id = diff["beatmap_id"]
         # Skip any diff that's not standard osu!
         if int(diff["mode"]) != api.GameMode.Standard.value:
-            continue
+            return
 
         # If the diff is cached and unchanged, use the cached pp
         if map_id in cached_mapset:
             if diff["file_md5"] == cached_mapset[map_id]["md5"]:
                 beatmapset[i]["pp"] = cached_mapset[map_id]["pp"]
-                continue
+                return
 
             # If it was changed, add an asterisk to the beatmap name (this is a really stupid place to do this)
             beatmapset[i]["version"] = "*" + diff["version"]
@@ -625,8 +868,8 @@ async def calculate_pp_for_beatmapset(beatmapset: list):
         try:
             pp_stats = await calculate_pp(int(map_id), ignore_cache=True)
         except ValueError:
-            logging.error(traceback.format_exc())
-            continue
+            logging.exception("Failed to calculate pp for map %s", map_id)
+            return
 
         beatmapset[i]["pp"] = pp_stats.pp
 
@@ -636,7 +879,138 @@ async def calculate_pp_for_beatmapset(beatmapset: list):
             "pp": pp_stats.pp,
         }
 
-    osu_config.save()
+    # The difficulties are calculated concurrently by the pp worker processes
+    await asyncio.gather(*(calculate_diff(i, diff) for i, diff in enumerate(beatmapset)))
+
+    # The map cache is written by the next plugin save rather than for every beatmapset
+    plugins.mark_dirty()
+
+
+async def send_map_event(channel: discord.Channel, embed: discord.Embed, event: MapEvent, to_delete: list):
+    """ Send a map event to a channel, replacing the message of the previous event in the channel. """
+    # Delete the previous message if there is one
+    delete_msg = discord.utils.get(to_delete, channel=channel)
+    if delete_msg:
+        try:
+            await client.delete_message(delete_msg)
+        except (discord.Forbidden, discord.NotFound):
+            pass
+
+    msg = await send_notification(channel, embed)
+    if msg:
+        event.messages.append(msg)
+
+
+class MapEventJob:
+    """ Map events of a beatmapset waiting for the beatmap API to catch up with them. """
+    def __init__(self, beatmapset_id: str, due: float):
+        self.beatmapset_id = beatmapset_id
+        self.due = due  # Loop time of the next beatmapset request
+        self.tries = 0
+        self.events = []  # List of (member_id, status_format, display_html) in the order they are posted
+        self.posted = 0  # The number of events posted, or being posted
+        self.beatmapset = None  # The requested beatmapset, with the pp of every difficulty
+
+
+def start_map_event_job(job: MapEventJob):
+    """ Run a map event job as a task of this plugin. """
+    plugins.create_task(run_map_event_job(job))
+
+
+def queue_map_event(member_id: str, beatmapset_id: str, status_format: str, html: str):
+    """ Queue a map event to be posted once the beatmap API has caught up with it.
+    Events of a beatmapset which is already queued are added to its pending job. """
+    job = map_event_jobs.get(beatmapset_id)
+    if job is None:
+        job = map_event_jobs[beatmapset_id] = MapEventJob(beatmapset_id, client.loop.time() + map_event_delay)
+        start_map_event_job(job)
+
+    event = (member_id, status_format, html)
+    if event not in job.events:
+        job.events.append(event)
+
+
+async def run_map_event_job(job: MapEventJob):
+    """ Run a map event job, and remove it once it's done. A cancelled job is kept,
+    since it's restarted when the plugin is reloaded. """
+    try:
+        await post_map_event_job(job)
+    except asyncio.CancelledError:
+        raise
+    except:
+        del map_event_jobs[job.beatmapset_id]
+        raise
+    else:
+        del map_event_jobs[job.beatmapset_id]
+
+
+async def post_map_event_job(job: MapEventJob):
+    """ Request the beatmapset of a map event job until it is found, then post the job's events.
+    Events added to the job while posting are posted too. """
+    if job.beatmapset is None:
+        # New beatmaps might take a few minutes to show up in the API
+        beatmapset = None
+        while not beatmapset and job.tries < map_event_tries:
+            await asyncio.sleep(max(0, job.due - client.loop.time()), loop=client.loop)
+            job.tries += 1
+            job.due = client.loop.time() + map_event_retry_delay
+            beatmapset = await api.get_beatmaps(s=job.beatmapset_id, revalidate=True)
+
+        if not beatmapset:
+            logging.warning("Beatmapset %s of %s map events was not found", job.beatmapset_id, len(job.events))
+            return
+
+        # Calculate (or retrieve cached info) the pp for every difficulty of this mapset
+        try:
+            await calculate_pp_for_beatmapset(beatmapset)
+        except ValueError:
+            logging.exception("Failed to calculate pp for beatmapset")
+
+        job.beatmapset = beatmapset
+
+    while job.posted < len(job.events):
+        member_id, status_format, html = job.events[job.posted]
+        job.posted += 1
+
+        # The member might have unlinked their profile since the event
+        if member_id in osu_config.data["profiles"]:
+            await post_map_event(member_id, status_format, html, job.beatmapset)
+
+
+async def post_map_event(member_id: str, status_format: str, html: str, beatmapset: list):
+    """ Post a map event to every server of the member. """
+    new_event = MapEvent(html)
+    prev = discord.utils.get(recent_map_events, text=html)
+    to_delete = []
+
+    if prev:
+        recent_map_events.remove(prev)
+
+        if prev.time_created + timedelta(hours=event_repeat_interval) > new_event.time_created:
+            to_delete = prev.messages
+            new_event.count = prev.count + 1
+            new_event.time_created = prev.time_created
+
+    # Always append the new event to the recent list
+    recent_map_events.append(new_event)
+
+    # Do not format difficulties when minimal (or pp) information is specified
+    minimal = get_update_mode(member_id) is not UpdateModes.Full
+
+    # Send the message to all servers at once, formatting the embed once for every server
+    sends = []
+    for route in get_notify_routes(member_id):
+        if not route.map_channels:
+            continue
+
+        embed = format_map_status(route.member, status_format, beatmapset, minimal)
+        if new_event.count > 1:
+            embed.set_footer(text="updated {} times since".format(new_event.count))
+            embed.timestamp = new_event.time_created
+
+        sends.extend(send_map_event(channel, embed, new_event, to_delete) for channel in route.map_channels)
+
+    await asyncio.gather(*sends)
 
 
 async def notify_maps(member_id: str, data: dict):
@@ -686,69 +1060,28 @@ async def notify_maps(member_id: str, data: dict):
             status_format = status_format.replace("<name>", "[**{name}**]({host}u/{user_id})")
             status_format = status_format.replace("<title>", "[**{artist} - {title}**]({host}s/{beatmapset_id})")
 
-        # We'll sleep for a long while to let the beatmap API catch up with the change
-        await asyncio.sleep(45)
+        queue_map_event(member_id, event["beatmapset_id"], status_format, html)
 
-        # Try returning the beatmap info 6 times with a span of a minute
-        # This might be needed when new maps are submitted
-        for _ in range(6):
-            beatmapset = await api.get_beatmaps(s=event["beatmapset_id"])
-            if beatmapset:
-                break
-            await asyncio.sleep(60)
-        else:
-            # well shit
-            continue
 
-        # Calculate (or retrieve cached info) the pp for every difficulty of this mapset
-        try:
-            await calculate_pp_for_beatmapset(beatmapset)
-        except ValueError:
-            logging.error(traceback.format_exc())
-
-        new_event = MapEvent(html)
-        prev = discord.utils.get(recent_map_events, text=html)
-        to_delete = []
-        
-        if prev:
-            recent_map_events.remove(prev)
+async def notify_members(notify):
+    """ Run a notify function for every tracked member concurrently, at most max_concurrent_requests
+    members at once. An error in one member's notification does not stop the others. """
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
 
-            if prev.time_created + timedelta(hours=event_repeat_interval) > new_event.time_created:
-                to_delete = prev.messages
-                new_event.count = prev.count + 1
-                new_event.time_created = prev.time_created
-        
-        # Always append the new event to the recent list
-        recent_map_events.append(new_event)
-
-        # Send the message to all servers
-        for server in client.servers:
-            member = server.get_member(member_id)
-            channels = get_notify_channels(server, "map")  # type: list
+    async def notify_member(member_id: str, data: dict):
+        async with semaphore:
+            await notify(member_id, data)
 
-            if not member or not channels:
-                continue
+    tracked = list(osu_tracking.items())
+    results = await asyncio.gather(*(notify_member(member_id, data) for member_id, data in tracked),
+                                   return_exceptions=True)
 
-            for channel in channels:
-                # Do not format difficulties when minimal (or pp) information is specified
-                update_mode = get_update_mode(member_id)
-                embed = format_map_status(member, status_format, beatmapset, update_mode is not UpdateModes.Full)
-                if new_event.count > 1:
-                    embed.set_footer(text="updated {} times since".format(new_event.count))
-                    embed.timestamp = new_event.time_created
-                
-                # Delete the previous message if there is one
-                if to_delete:
-                    delete_msg = discord.utils.get(to_delete, channel=channel)
-                    await client.delete_message(delete_msg)
-                    to_delete.remove(delete_msg)
-
-                try:
-                    msg = await client.send_message(channel, embed=embed)
-                except discord.errors.Forbidden:
-                    pass
-                else:
-                    new_event.messages.append(msg)
+    for (member_id, data), result in zip(tracked, results):
+        if isinstance(result, asyncio.CancelledError):
+            raise result
+        if isinstance(result, Exception):
+            logging.error("Error in %s for %s", notify.__name__, data["member"],
+                          exc_info=(type(result), result, result.__traceback__))
 
 
 async def on_ready():
@@ -759,6 +1092,7 @@ async def on_ready():
     if osu_config.data["key"] == "change to your api key":
         logging.warning("osu! functionality is unavailable until an API key is provided (config/osu.json)")
 
+    started = datetime.now()
     while not client.loop.is_closed():
         try:
             await asyncio.sleep(update_interval, loop=client.loop)
@@ -768,21 +1102,17 @@ async def on_ready():
             await update_user_data()
 
             # Next, check for any differences in pp between the "old" and the "new" subsections
-            # and notify any servers
-            # NOTE: This used to also be ensure_future before adding the potential pp check.
-            # The reason for this change is to ensure downloading and running the .osu files won't happen twice
-            # at the same time, which would cause problems retrieving the correct potential pp.
-            for member_id, data in osu_tracking.items():
-                await notify_pp(member_id, data)
+            # and notify any servers. Every .osu file is stored separately, so members are notified concurrently
+            await notify_members(notify_pp)
 
             # Check for any differences in the users' events and post about map updates
-            # NOTE: the same applies to this now. These can't be concurrent as they also calculate pp.
-            for member_id, data in osu_tracking.items():
-                await notify_maps(member_id, data)
+            await notify_members(notify_maps)
         except aiohttp.ClientOSError as e:
             logging.error(str(e))
+        except asyncio.CancelledError:  # The plugin was reloaded
+            raise
         except:
-            logging.error(traceback.format_exc())
+            logging.exception("Unexpected error in osu! notify task")
         finally:
             pass
             # TODO: setup logging
@@ -790,17 +1120,42 @@ async def on_ready():
             # Save the time elapsed since we started the update
             time_elapsed = (datetime.now() - started).total_seconds()
 
+            # Beatmaps cached during the update or by commands are written by the next plugin save
+            if api.beatmap_cache.dirty:
+                plugins.mark_dirty()
+
+
+async def save(_):
+    """ Save the map cache and the beatmap cache updated since the last save. """
+    osu_config.save()
+
+    if api.beatmap_cache.dirty:
+        await client.loop.run_in_executor(None, api.beatmap_cache.write, api.beatmap_cache.snapshot())
+
 
 async def on_reload(name: str):
-    """ Preserve the tracking cache. """
-    global osu_tracking, recent_map_events
+    """ Preserve the tracking cache and the pending map events. """
+    global osu_tracking, recent_map_events, poll_schedule, map_event_jobs
     local_tracking = osu_tracking
     local_events = recent_map_events
+    local_schedule = poll_schedule
+    local_jobs = map_event_jobs
 
     await plugins.reload(name)
 
     osu_tracking = local_tracking
     recent_map_events = local_events
+    poll_schedule = local_schedule
+    map_event_jobs = local_jobs
+
+    # The map event jobs were cancelled along with every other task of the plugin
+    for job in map_event_jobs.values():
+        start_map_event_job(job)
+
+
+def on_unload():
+    """ Stop the pp calculation workers. """
+    shutdown_executor()
 
 
 def get_timestamps_with_url(content: str):
@@ -814,7 +1169,10 @@ def get_timestamps_with_url(content: str):
         yield match.group(0), "<osu://edit/{}>".format(url)
 
 
-@plugins.event()
+triggers.set_triggers("osu", patterns=[timestamp_pattern])
+
+
+@plugins.event(triggers="osu")
 async def on_message(message):
     # Ignore commands
     if message.content.startswith("!"):
@@ -913,6 +1271,7 @@ async def link(message: discord.Message, name: Annotate.LowerContent):
     osu_config.data["mode"][message.author.id] = mode.value
     osu_config.data["primary_server"][message.author.id] = message.server.id
     osu_config.save()
+    invalidate_notify_routes()
     await client.say(message, "Set your osu! profile to `{}`.".format(osu_user["username"]))
 
 
@@ -930,6 +1289,7 @@ async def unlink(message: discord.Message, member: discord.Member=Annotate.Self)
     # Unlink the given member (usually the message author)
     del osu_config.data["profiles"][member.id]
     osu_config.save()
+    invalidate_notify_routes()
     await client.say(message, "Unlinked **{}'s** osu! profile.".format(member.name))
 
 
@@ -1029,28 +1389,77 @@ async def pp_(message: discord.Message, beatmap_url: str, *options):
     options = list(options)
     if type(pp_stats) is ClosestPPStats:
         # Remove any accuracy percentage from options as we're setting this manually, and remove unused options
-        for opt in options:
-            if opt.endswith("%") or opt.endswith("pp") or opt.endswith("x300") or opt.endswith("x100") or opt.endswith("x50"):
-                options.remove(opt)
+        options = [opt for opt in options if not opt.endswith(("%", "pp", "x300", "x100", "x50"))]
 
-        options.insert(0, "{}%".format(pp_stats.acc))
+        # Show the accuracy along with the hit counts it is made of
+        options.insert(0, "{0.acc}% ({0.c100}x100 {0.c50}x50)".format(pp_stats))
 
     await client.say(message, "*{artist} - {title}* **[{version}] {0}** {stars:.02f}\u2605 would be worth `{pp:,.02f}pp`.".format(
         " ".join(options), **pp_stats._asdict()))
 
 
+pp_table_mods = ("Nomod", "HD", "HR", "DT", "HDHR", "HDDT")
+pp_table_accuracies = (95, 97, 98, 99, 100)
+
+
+async def pp_table(message: discord.Message, beatmap_url: str, *mods: str):
+    """ Display a table of the pp a beatmap is worth for every accuracy and set of mods.
+
+    The mods are given as e.g. `+HD +HDDT`, and defaults to the most common mods.
+    """
+    mods = [mod.lstrip("+").upper() for mod in mods] or list(pp_table_mods)
+    assert len(mods) <= 10, "Please give at most 10 sets of mods."
+
+    options_list = [["{}%".format(acc)] + (["+" + mod] if not mod == "NOMOD" else [])
+                    for mod in mods for acc in pp_table_accuracies]
+    try:
+        pp_stats = await calculate_pp_batch(beatmap_url, options_list)
+    except ValueError as e:
+        await client.say(message, str(e))
+        return
+
+    rows = ["{:<7}{:>7}".format("Mods", "Stars") + "".join("{:>9}".format("{}%".format(acc))
+                                                        for acc in pp_table_accuracies)]
+    for i, mod in enumerate(mods):
+        row = pp_stats[i * len(pp_table_accuracies):(i + 1) * len(pp_table_accuracies)]
+        rows.append("{:<7}{:>6.2f}\u2605".format(mod.capitalize() if mod == "NOMOD" else mod, row[0].stars) +
+                    "".join("{:>9.2f}".format(stats.pp) for stats in row))
+
+    await client.say(message, "*{artist} - {title}* **[{version}]**```\n{0}```".format(
+        "\n".join(rows), **pp_stats[0]._asdict()))
+
+
 if can_calc_pp:
-    plugins.command(name="pp", aliases="oppai")(pp_)
-    osu.command(name="pp", aliases="oppai")(pp_)
+    # Registering pp_ again replaces its subcommand decorator, so the decorator of each command is kept
+    pp_subcommand = plugins.command(name="pp", aliases="oppai")(pp_).command
+    osu_pp_subcommand = osu.command(name="pp", aliases="oppai")(pp_).command
+
+    # The table subcommand is added to both the pp command and the osu pp command
+    pp_subcommand(name="table")(pp_table)
+    osu_pp_subcommand(name="table")(pp_table)
 
 
 async def create_score_embed_with_pp(member: discord.Member, score, beatmap, mode):
     mods = api.Mods.format_mods(int(score["enabled_mods"]))
 
-    score_pp = await calculate_pp(int(score["beatmap_id"]), *"{mods}{acc:.2%} {countmiss}m {maxcombo}x".format(
-        acc=calculate_acc(mode, score), mods="+" + mods + " " if mods != "Nomod" else "", **score).split())
-    potential_pp = await get_potential_pp(score, beatmap, member, round(score_pp.pp, 2), use_acc=True)
-    score["pp"] = round(score_pp.pp, 2)
+    score_options = "{mods}{acc:.2%} {countmiss}m {maxcombo}x".format(
+        acc=calculate_acc(mode, score), mods="+" + mods + " " if mods != "Nomod" else "", **score).split()
+    potential_options = get_potential_pp_options(score, beatmap, member, use_acc=True)
+
+    # The score pp and the potential pp are calculated from the same parsed beatmap
+    options_list = [score_options] + ([potential_options] if potential_options else [])
+    try:
+        pp_stats = await calculate_pp_batch(int(score["beatmap_id"]), options_list)
+    except Exception:
+        if not potential_options:
+            raise
+
+        # The potential pp is left out when it can't be calculated
+        logging.exception("Failed to calculate potential pp")
+        potential_options = None
+        pp_stats = await calculate_pp_batch(int(score["beatmap_id"]), [score_options])
+    score["pp"] = round(pp_stats[0].pp, 2)
+    potential_pp = filter_potential_pp(pp_stats[1].pp, score["pp"]) if potential_options else None
 
     # TODO: Calculate where the player failed
     embed = get_formatted_score_embed(member, score, await format_new_score(mode, score, beatmap), potential_pp)
@@ -1147,6 +1556,7 @@ async def scores(message: discord.Message, *channels: discord.Channel):
     init_server_config(message.server)
     osu_config.data["server"][message.server.id]["score-channels"] = list(c.id for c in channels)
     osu_config.save()
+    invalidate_notify_routes()
     await client.say(message, "**Notifying scores in**: {}".format(
         utils.format_objects(*channels, sep=" ") or "no channels"))
 
@@ -1157,6 +1567,7 @@ async def maps(message: discord.Message, *channels: discord.Channel):
     init_server_config(message.server)
     osu_config.data["server"][message.server.id]["map-channels"] = list(c.id for c in channels)
     osu_config.save()
+    invalidate_notify_routes()
     await client.say(message, "**Notifying map updates in**: {}".format(
         utils.format_objects(*channels, sep=" ") or "no channels"))
 
@@ -1164,12 +1575,37 @@ async def maps(message: discord.Message, *channels: discord.Channel):
 @osu.command(owner=True)
 async def debug(message: discord.Message):
     """ Display some debug info. """
+    now = client.loop.time()
+    scheduled = sorted(((data["next_poll"], data["interval"], data["member"]) for data in osu_tracking.values()
+                        if "next_poll" in data), key=lambda poll: poll[0])
+    schedule = "\n".join("{2.display_name:<20} in {0:>6.0f}s (every {1:.0f}s)".format(max(0, next_poll - now),
+                                                                                 interval, member)
+                         for next_poll, interval, member in scheduled[:10])
+    pending = "\n".join("{0.beatmapset_id:<10} in {1:>6.0f}s ({2} events, try {0.tries}/{3})".format(
+        job, max(0, job.due - now), len(job.events), map_event_tries) for job in list(map_event_jobs.values())[:10])
+    if len(map_event_jobs) > 10:
+        pending += "\n... and {} more".format(len(map_event_jobs) - 10)
+
     await client.say(message, "Sent `{}` requests since the bot started (`{}`).\n"
                               "Spent `{:.3f}` seconds last update.\n"
+                              "Last poll: `{duration:.3f}` seconds, `{requests}` requests, `{updated}` updated, "
+                              "`{skipped}` skipped, `{failed}` failed.\n"
                               "Members registered as playing: {}\n"
-                              "Total members tracked: `{}`".format(
+                              "Total members tracked: `{}`\n"
+                              "New scores found in recent plays: `{recent}`, top plays downloaded: `{best}`\n"
+                              "Beatmap cache: `{cache.hits}` hits, `{cache.misses}` misses (`{cache.hit_rate:.0%}`), "
+                              "`{entries}` entries, `{cache.changed}` changed on revalidation\n"
+                              "Next polls (budget of `{budget}` per update):```\n{schedule}```"
+                              "Pending map events:```\n{pending}```".format(
         api.requests_sent, client.time_started.ctime(),
         time_elapsed,
         utils.format_objects(*[d["member"] for d in osu_tracking.values() if is_playing(d["member"])], dec="`"),
-        len(osu_tracking)
+        len(osu_tracking),
+        budget=poll_budget(),
+        cache=api.beatmap_cache,
+        entries=len(api.beatmap_cache.entries),
+        **new_score_lookups,
+        schedule=schedule or "None",
+        pending=pending or "None",
+        **last_poll
     ))
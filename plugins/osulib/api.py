@@ -4,17 +4,23 @@
     request functions.
 """
 
+import asyncio
+import gzip
+import json
 import logging
+import os
 import re
-from collections import namedtuple
+import time
+from collections import namedtuple, OrderedDict
 from enum import Enum
 
-from pcbot import utils
+from pcbot import utils, Config
 
 
 api_url = "https://osu.ppy.sh/api/"
 api_key = ""
 requests_sent = 0
+requests_per_minute = 1200  # The osu! API quota
 
 ripple_url = "https://ripple.moe/api/"
 ripple_pattern = re.compile(r"ripple:\s*(?P<data>.+)")
@@ -35,6 +41,46 @@ def set_api_key(s: str):
     api_key = s
 
 
+class TokenBucket:
+    """ Token bucket which limits the rate of requests, while allowing short bursts. """
+    def __init__(self, rate: float, capacity: float):
+        """
+        :param rate: Tokens added every second.
+        :param capacity: The maximum number of tokens, which is the largest burst allowed.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+
+    def _refill(self, now: float):
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """ Take a token, sleeping until one is available. """
+        loop = asyncio.get_event_loop()
+        while True:
+            self._refill(loop.time())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+quota = TokenBucket(requests_per_minute / 60, requests_per_minute / 60)
+
+
+def set_quota(per_minute: int):
+    """ Set the number of requests per minute allowed to the osu! API. Requests
+    to ripple do not count towards the quota. """
+    global requests_per_minute, quota
+    requests_per_minute = per_minute
+    quota = TokenBucket(per_minute / 60, per_minute / 60)
+
+
 class GameMode(Enum):
     """ Enum for gamemodes. """
     Standard = 0
@@ -140,6 +186,10 @@ def def_section(api_name: str, first_element: bool=False):
 
         # Download using a URL of the given API function name
         for i in range(request_tries):
+            # Wait for the request quota of the official API
+            if url == api_url:
+                await quota.acquire()
+
             try:
                 json = await utils.download_json(url + api_name, **params)
             except ValueError as e:
@@ -166,7 +216,7 @@ def def_section(api_name: str, first_element: bool=False):
 
 
 # Define all osu! API requests using the template
-get_beatmaps = def_section("get_beatmaps")
+request_beatmaps = def_section("get_beatmaps")
 get_user = def_section("get_user", first_element=True)
 get_scores = def_section("get_scores")
 get_user_best = def_section("get_user_best")
@@ -174,6 +224,152 @@ get_user_recent = def_section("get_user_recent")
 get_match = def_section("get_match", first_element=True)
 get_replay = def_section("get_replay")
 
+permanent_statuses = ("1", "2", "4")  # The approved values of ranked, approved and loved beatmaps
+
+
+class BeatmapCache:
+    """ Persistent cache of beatmap metadata requested with get_beatmaps.
+
+    Ranked, approved and loved beatmaps never change, so they are cached indefinitely.
+    Any other beatmaps are requested again once they are older than the ttl. The cache
+    is stored as gzip compressed JSON.
+    """
+    def __init__(self, filename: str, ttl: float=60 * 60, maxsize: int=20000):
+        self.filename = filename
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key: dict(time=time requested, beatmaps=list of beatmap dicts)
+        self.hits = 0
+        self.misses = 0
+        self.changed = 0  # The number of stale entries which were requested again and had a changed file_md5
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        """ Load the cache from disk if it exists. """
+        if not os.path.exists(self.filename):
+            return
+
+        try:
+            with gzip.open(self.filename, "rt", encoding="utf-8") as f:
+                self.entries = OrderedDict(json.load(f))
+        except (OSError, ValueError):
+            logging.exception("Could not load the beatmap cache from %s", self.filename)
+
+    def snapshot(self):
+        """ Return the entries to write with write(), and mark the cache as saved. """
+        self.dirty = False
+        return list(self.entries.items())
+
+    def write(self, entries: list):
+        """ Write a snapshot of the entries to disk. The file is only replaced once written,
+        so this can run in an executor. """
+        with gzip.open(self.filename + ".tmp", "wt", encoding="utf-8") as f:
+            json.dump(entries, f, separators=(",", ":"))
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def is_fresh(self, entry: dict):
+        """ Return True if the entry does not need to be requested again. """
+        if all(beatmap["approved"] in permanent_statuses for beatmap in entry["beatmaps"]):
+            return True
+
+        return time.time() - entry["time"] < self.ttl
+
+    def get(self, key: str):
+        """ Return copies of the cached beatmaps, or None if they are not cached or stale. """
+        entry = self.entries.get(key)
+        if entry is None or not self.is_fresh(entry):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return [dict(beatmap) for beatmap in entry["beatmaps"]]
+
+    def peek(self, key: str):
+        """ Return the cached beatmaps without counting the lookup, or None if they are not cached or stale. """
+        entry = self.entries.get(key)
+        if entry is None or not self.is_fresh(entry):
+            return None
+
+        return [dict(beatmap) for beatmap in entry["beatmaps"]]
+
+    def set(self, key: str, beatmaps: list):
+        """ Cache requested beatmaps. Cached single beatmaps with a changed file_md5 are removed. """
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            previous_md5 = {beatmap["beatmap_id"]: beatmap["file_md5"] for beatmap in previous["beatmaps"]}
+            changed_ids = set(beatmap["beatmap_id"] for beatmap in beatmaps
+                              if not previous_md5.get(beatmap["beatmap_id"]) == beatmap["file_md5"])
+            if changed_ids:
+                self.changed += 1
+                self._remove_beatmaps(changed_ids)
+
+        self.entries[key] = dict(time=time.time(), beatmaps=[dict(beatmap) for beatmap in beatmaps])
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+        self.dirty = True
+
+    def _remove_beatmaps(self, beatmap_ids: set):
+        """ Remove the cached single beatmaps with any of the given ids. """
+        for key in [k for k in self.entries if k.split(":")[1] in beatmap_ids and k.startswith("b:")]:
+            del self.entries[key]
+
+    @property
+    def hit_rate(self):
+        """ The share of lookups which were cached. """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+
+beatmap_cache = BeatmapCache(Config.config_path + "osu_beatmaps.json.gz")
+cacheable_beatmap_params = {"b", "s", "m", "a", "limit", "request_tries"}
+
+
+def beatmap_cache_key(params: dict):
+    """ Return the cache key of get_beatmaps parameters, or None when the request can't be cached. """
+    if not set(params) <= cacheable_beatmap_params or ("b" in params) == ("s" in params):
+        return None
+
+    # Requests for a beatmapset may be limited to fewer beatmaps
+    if "s" in params and "limit" in params:
+        return None
+
+    return "{}:{}:{}:{}".format("b" if "b" in params else "s", params.get("b", params.get("s")),
+                                params.get("m", ""), params.get("a", ""))
+
+
+async def get_beatmaps(revalidate: bool=False, **params):
+    """ Get list using get_beatmaps. Lookups of a beatmap_id or beatmapset_id are
+    cached in beatmap_cache.
+
+    :param revalidate: Request the beatmaps even when cached, and update the cache.
+    """
+    key = beatmap_cache_key(params)
+    if key is None:
+        return await request_beatmaps(**params)
+
+    if not revalidate:
+        beatmaps = beatmap_cache.get(key)
+        if beatmaps is not None:
+            return beatmaps
+
+    beatmaps = await request_beatmaps(**params)
+    if not beatmaps:
+        return beatmaps
+
+    beatmap_cache.set(key, beatmaps)
+
+    # A beatmapset also holds every single beatmap requested with the same mode
+    if key.startswith("s:"):
+        beatmap_params = {k: v for k, v in params.items() if not k == "s"}
+        for beatmap in beatmaps:
+            beatmap_cache.set(beatmap_cache_key(dict(beatmap_params, b=beatmap["beatmap_id"])), [beatmap])
+
+    return beatmaps
+
+
 beatmap_url_pattern_v1 = re.compile(r"https?://(osu|old)\.ppy\.sh/(?P<type>[bs])/(?P<id>\d+)(?:\?m=(?P<mode>\d))?")
 beatmap_url_pattern_v2 = re.compile(r"https?://osu\.ppy\.sh/beatmapsets/(?P<beatmapset_id>\d+)(?:#(?P<mode>\w+)/(?P<beatmap_id>\d+))?")
 
@@ -2,29 +2,42 @@
     https://github.com/Francesco149/oppai-ng
 """
 
+import asyncio
+import hashlib
+import importlib.util
+import multiprocessing
 import os
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
 
 from pcbot import utils
-from . import api
+from . import api, ppworker
 from .args import parse as parse_options
 
-try:
-    from oppai import *
-    can_calc_pp = True
-except:
-    can_calc_pp = False
+# The calculations are run by ppworker, so only check that oppai is installed
+can_calc_pp = importlib.util.find_spec("oppai") is not None
 
 host = "https://osu.ppy.sh/"
 
-CachedBeatmap = namedtuple("CachedBeatmap", "url_or_id beatmap")
 PPStats = namedtuple("PPStats", "pp stars artist title version ar od hp cs")
-ClosestPPStats = namedtuple("ClosestPPStats", "acc pp stars artist title version")
+ClosestPPStats = namedtuple("ClosestPPStats", "acc pp stars artist title version c100 c50")
 
 plugin_path = "plugins/osulib/"
-beatmap_path = os.path.join(plugin_path, "map.osu")
-cached_beatmap = CachedBeatmap(url_or_id=None, beatmap=None)
+beatmap_path = os.path.join(plugin_path, "beatmaps/")  # Directory of .osu files named <beatmap_id>-<md5>.osu
+max_beatmap_bytes = 64 * 1024 * 1024  # The size the .osu files are kept under
+max_parsed_beatmaps = 32  # The number of .osu files kept in memory
+
+parsed_beatmaps = OrderedDict()  # md5: .osu file contents
+downloads = {}  # beatmap_url_or_id: asyncio.Task
+beatmap_bytes = None  # The total size of the .osu files, computed when first needed
+stored_beatmaps = None  # beatmap_id: md5 of the stored .osu file, indexed when first needed
+
+pp_workers = min(2, os.cpu_count() or 1)  # The number of worker processes calculating pp
+pp_timeout = 30  # Seconds before a pp calculation is abandoned
+pp_executor = None  # type: ProcessPoolExecutor
+pending_calculations = {}  # md5: (beatmap, list of (options, asyncio.Future)) not yet sent to a worker
 
 
 async def is_osu_file(url: str):
@@ -33,9 +46,109 @@ async def is_osu_file(url: str):
     return "text/plain" in headers.get("Content-Type", "") and ".osu" in headers.get("Content-Disposition", "")
 
 
+def get_beatmap_file(beatmap_id, md5: str):
+    """ Return the path of a stored .osu file. """
+    return os.path.join(beatmap_path, "{}-{}.osu".format(beatmap_id, md5))
+
+
+def get_stored_beatmaps():
+    """ Return the index of stored .osu files by beatmap id. When several files of a beatmap
+    are stored, the most recently used is indexed. """
+    global stored_beatmaps
+
+    if stored_beatmaps is None:
+        stored_beatmaps = {}
+        if os.path.exists(beatmap_path):
+            entries = sorted((entry for entry in os.scandir(beatmap_path) if entry.name.endswith(".osu")),
+                             key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                beatmap_id, _, md5 = entry.name[:-len(".osu")].partition("-")
+                stored_beatmaps[beatmap_id] = md5
+
+    return stored_beatmaps
+
+
+def remember_beatmap(md5: str, beatmap: str):
+    """ Keep the contents of a .osu file in memory, forgetting the least recently used. """
+    parsed_beatmaps[md5] = beatmap
+    parsed_beatmaps.move_to_end(md5)
+    while len(parsed_beatmaps) > max_parsed_beatmaps:
+        parsed_beatmaps.popitem(last=False)
+
+
+def store_beatmap(beatmap_id, md5: str, beatmap_file: bytes):
+    """ Write a .osu file, and remove the least recently used files when the directory
+    grows past max_beatmap_bytes. The file is written to a temporary file first, so that
+    it's never read incomplete. """
+    global beatmap_bytes
+
+    if not os.path.exists(beatmap_path):
+        os.makedirs(beatmap_path)
+
+    if beatmap_bytes is None:
+        beatmap_bytes = sum(entry.stat().st_size for entry in os.scandir(beatmap_path) if entry.is_file())
+
+    path = get_beatmap_file(beatmap_id, md5)
+    temporary_path = "{}.{}.tmp".format(path, id(beatmap_file))
+    with open(temporary_path, "wb") as f:
+        f.write(beatmap_file)
+    os.replace(temporary_path, path)
+    beatmap_bytes += len(beatmap_file)
+
+    # Only the newest file of a beatmap is kept
+    previous_md5 = get_stored_beatmaps().get(str(beatmap_id))
+    stored_beatmaps[str(beatmap_id)] = md5
+    if previous_md5 is not None and not previous_md5 == md5:
+        previous_path = get_beatmap_file(beatmap_id, previous_md5)
+        try:
+            beatmap_bytes -= os.path.getsize(previous_path)
+            os.remove(previous_path)
+        except FileNotFoundError:
+            pass
+
+    if beatmap_bytes <= max_beatmap_bytes:
+        return
+
+    # Files are touched when read, so the oldest modified files are the least recently used
+    entries = sorted((entry for entry in os.scandir(beatmap_path) if entry.name.endswith(".osu")),
+                     key=lambda entry: entry.stat().st_mtime)
+    beatmap_bytes = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if beatmap_bytes <= max_beatmap_bytes or entry.path == path:
+            break
+
+        beatmap_bytes -= entry.stat().st_size
+        os.remove(entry.path)
+
+        beatmap_id, _, entry_md5 = entry.name[:-len(".osu")].partition("-")
+        if stored_beatmaps.get(beatmap_id) == entry_md5:
+            del stored_beatmaps[beatmap_id]
+
+
+def read_beatmap(beatmap_id, md5: str):
+    """ Return the contents of a stored .osu file, or None if it's not stored. """
+    if md5 in parsed_beatmaps:
+        parsed_beatmaps.move_to_end(md5)
+        return parsed_beatmaps[md5]
+
+    # The file might be replaced by a newer version of the beatmap at any time
+    path = get_beatmap_file(beatmap_id, md5)
+    try:
+        with open(path, encoding="utf-8") as fp:
+            beatmap = fp.read()
+    except FileNotFoundError:
+        return None
+
+    os.utime(path)
+    remember_beatmap(md5, beatmap)
+    return beatmap
+
+
 async def download_beatmap(beatmap_url_or_id):
-    """ Download the .osu file of the beatmap with the given url, and save it to beatmap_path.
+    """ Download the .osu file of the beatmap with the given url, and store it by its id and md5.
+
     :param beatmap_url_or_id: beatmap_url as str or the id as int
+    :return: The contents of the .osu file.
     """
     # Parse the url and find the link to the .osu file
     try:
@@ -49,6 +162,7 @@ async def download_beatmap(beatmap_url_or_id):
             raise ValueError(e)
 
         file_url = beatmap_url_or_id
+        beatmap_id = None
     else:
         file_url = host + "osu/" + str(beatmap_id)
 
@@ -57,152 +171,176 @@ async def download_beatmap(beatmap_url_or_id):
     if not beatmap_file:
         raise ValueError("The given URL is invalid.")
 
-    with open(beatmap_path, "wb") as f:
-        f.write(beatmap_file)
-
     # one map apparently had a /ufeff at the very beginning of the file???
     # https://osu.ppy.sh/b/1820921
-    if not beatmap_file.decode().strip("\ufeff \t").startswith("osu file format"):
-        logging.error("Invalid file received from {}\nCheck {}".format(file_url, beatmap_path))
+    beatmap = beatmap_file.decode()
+    if not beatmap.strip("\ufeff \t").startswith("osu file format"):
+        logging.error("Invalid file received from {}".format(file_url))
         raise ValueError("Could not download the .osu file.")
 
+    # Only beatmaps from the osu! website are stored, since other urls may change their file
+    md5 = hashlib.md5(beatmap_file).hexdigest()
+    if beatmap_id is not None:
+        store_beatmap(beatmap_id, md5, beatmap_file)
+
+    remember_beatmap(md5, beatmap)
+    return beatmap
+
+
+async def get_beatmap_md5(beatmap_url_or_id):
+    """ Return the beatmap id and the md5 of its stored .osu file, or None when it's not stored.
+    The md5 in the beatmap's metadata is used when the metadata is already cached, so that
+    changed beatmaps are downloaded again. """
+    try:
+        if type(beatmap_url_or_id) is str:
+            beatmap_id = await api.beatmap_from_url(beatmap_url_or_id, return_type="id")
+        else:
+            beatmap_id = beatmap_url_or_id
+    except SyntaxError:
+        return None
+
+    beatmaps = api.beatmap_cache.peek(api.beatmap_cache_key(dict(b=beatmap_id)))
+    if beatmaps:
+        return beatmap_id, beatmaps[0]["file_md5"]
+
+    md5 = get_stored_beatmaps().get(str(beatmap_id))
+    if md5 is None:
+        return None
+
+    return beatmap_id, md5
+
 
 async def parse_map(beatmap_url_or_id, ignore_cache: bool=False):
-    """ Download and parse the map with the given url or id, or return a newly parsed cached version.
+    """ Download and parse the map with the given url or id, or return a stored version.
+    Concurrent downloads of the same map are only downloaded once.
 
     :param beatmap_url_or_id: beatmap_url as str or the id as int
     :param ignore_cache: When true, the .osu will always be downloaded
     """
-    global cached_beatmap
+    if not ignore_cache:
+        stored = await get_beatmap_md5(beatmap_url_or_id)
+        if stored is not None:
+            beatmap = read_beatmap(*stored)
+            if beatmap is not None:
+                return beatmap
 
-    # Parse from cache or load the .osu and parse new
-    if not ignore_cache and beatmap_url_or_id == cached_beatmap.url_or_id:
-        with open(beatmap_path, encoding="utf-8") as fp:
-            beatmap = fp.read()
+    if beatmap_url_or_id not in downloads:
+        downloads[beatmap_url_or_id] = asyncio.ensure_future(download_beatmap(beatmap_url_or_id))
+        downloads[beatmap_url_or_id].add_done_callback(lambda _: downloads.pop(beatmap_url_or_id, None))
+
+    return await asyncio.shield(downloads[beatmap_url_or_id])
+
+
+def get_executor():
+    """ Return the process pool running pp calculations, starting it if needed. """
+    global pp_executor
+    if pp_executor is None:
+        # Forking the bot's threads and connections is unsafe, so the workers start from a fresh interpreter
+        pp_executor = ProcessPoolExecutor(max_workers=pp_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    return pp_executor
+
+
+def recycle_executor(executor: ProcessPoolExecutor):
+    """ Shut down a process pool which failed or has a calculation stuck, so that the next
+    calculation starts new workers. A calculation can't be cancelled once it's running, so
+    the old workers exit when their current calculation is done. """
+    global pp_executor
+    if pp_executor is executor:
+        pp_executor = None
+
+    executor.shutdown(wait=False)
+
+
+def shutdown_executor():
+    """ Shut down the process pool running pp calculations, if it was started. """
+    if pp_executor is not None:
+        recycle_executor(pp_executor)
+
+
+def get_calculation_options(args):
+    """ Return the plain options sent to the worker for parsed pp arguments. """
+    return dict(acc=args.acc, c100=args.c100, c50=args.c50, ar=args.ar, hp=args.hp, od=args.od, cs=args.cs,
+                combo=args.combo, misses=args.misses, score_version=args.score_version, pp=args.pp,
+                mods=sum(mod.value for mod in args.mods) if args.mods else 0)
+
+
+async def submit_calculations(md5: str):
+    """ Send every calculation pending for a beatmap to a worker process, and resolve their futures. """
+    beatmap, calculations = pending_calculations.pop(md5)
+    loop = asyncio.get_event_loop()
+    executor = get_executor()
+    try:
+        results = await asyncio.wait_for(loop.run_in_executor(
+            executor, ppworker.calculate_many, md5, beatmap, [options for options, _ in calculations]),
+            pp_timeout)
+    except asyncio.TimeoutError:
+        logging.error("A pp calculation of beatmap %s timed out; restarting the workers", md5)
+        recycle_executor(executor)
+        error = ValueError("The pp calculation timed out.")
+    except BrokenProcessPool:
+        logging.error("A pp calculation worker stopped unexpectedly; restarting the workers")
+        recycle_executor(executor)
+        error = ValueError("The pp calculation failed.")
+    except Exception as e:
+        error = e
     else:
-        await download_beatmap(beatmap_url_or_id)
-        with open(beatmap_path, encoding="utf-8") as fp:
-            beatmap = fp.read()
+        for (options, future), result in zip(calculations, results):
+            if future.done():
+                continue
 
-        cached_beatmap = CachedBeatmap(url_or_id=beatmap_url_or_id, beatmap=beatmap)
+            if isinstance(result, ValueError):
+                future.set_exception(result)
+            elif options["pp"] is not None:
+                future.set_result(ClosestPPStats(*result))
+            else:
+                future.set_result(PPStats(*result))
+        return
 
-    return beatmap
+    for _, future in calculations:
+        if not future.done():
+            future.set_exception(error)
+
+
+async def run_calculations(beatmap: str, options_list: list):
+    """ Calculate the pp of a beatmap for every dict of options in a worker process.
+    Calculations on the same beatmap requested at once are sent to the worker together.
+
+    :return: A list of PPStats, or ClosestPPStats when the options include pp, in the order of the options.
+    """
+    md5 = hashlib.md5(beatmap.encode(errors="replace")).hexdigest()
+    futures = [asyncio.Future() for _ in options_list]
+
+    if md5 not in pending_calculations:
+        pending_calculations[md5] = (beatmap, [])
+        asyncio.ensure_future(submit_calculations(md5))
+    pending_calculations[md5][1].extend(zip(options_list, futures))
+
+    return await asyncio.gather(*futures)
 
 
 async def calculate_pp(beatmap_url_or_id, *options, ignore_cache: bool=False):
     """ Return a PPStats namedtuple from this beatmap, or a ClosestPPStats namedtuple
-    when [pp_value]pp is given in the options.
+    when [pp_value]pp is given in the options. The calculation runs in a worker process.
 
     :param beatmap_url_or_id: beatmap_url as str or the id as int
     :param ignore_cache: When true, the .osu will always be downloaded
+    :raise ValueError: The beatmap or options are invalid, or the calculation failed.
     """
-    ez = ezpp_new()
-    ezpp_set_autocalc(ez, 1)
     beatmap = await parse_map(beatmap_url_or_id, ignore_cache=ignore_cache)
     args = parse_options(*options)
+    return (await run_calculations(beatmap, [get_calculation_options(args)]))[0]
 
-    ezpp_data_dup(ez, beatmap, len(beatmap.encode(errors="replace")))
 
-    # Set accuracy based on arguments
-    if args.acc is not None:
-        ezpp_set_accuracy_percent(ez, args.acc)
-    else:
-        ezpp_set_accuracy(ez, args.c100, args.c50)
-
-    # Set args if needed
-    # TODO: these don't seem to actually be applied in calculation, although
-    # they work in the native C version of oppai-ng
-    if args.ar:
-        ezpp_set_base_ar(ez, args.ar)
-    if args.hp:
-        ezpp_set_base_hp(ez, args.hp)
-    if args.od:
-        ezpp_set_base_od(ez, args.od)
-    if args.cs:
-        ezpp_set_base_cs(ez, args.cs)
-
-    # Set combo
-    if args.combo is not None:
-        ezpp_set_combo(ez, args.combo)
-
-    # Calculate the mod bitmask and apply settings if needed
-    mods_bitmask = sum(mod.value for mod in args.mods) if args.mods else 0
-    ezpp_set_mods(ez, mods_bitmask)
-
-    # Calculate the star difficulty
-    totalstars = ezpp_stars(ez)
-
-    # Set number of misses
-    ezpp_set_nmiss(ez, args.misses)
-
-    # Set score version
-    ezpp_set_score_version(ez, args.score_version)
-
-    # Parse artist name
-    artist = ezpp_artist(ez)
-
-    # Parse beatmap title
-    title = ezpp_title(ez)
-
-    # Parse difficulty name
-    version = ezpp_version(ez)
-
-    # # If the pp arg is given, return using the closest pp function
-    # if args.pp is not None:
-    #     return await find_closest_pp(beatmap, args)
-
-    ar = ezpp_ar(ez)
-    od = ezpp_od(ez)
-    hp = ezpp_hp(ez)
-    cs = ezpp_cs(ez)
-
-    # Calculate the pp
-    pp = ezpp_pp(ez)
-    ezpp_free(ez)
-    return PPStats(pp, totalstars, artist, title, version, ar, od, hp, cs)
-
-# async def find_closest_pp(beatmap, args):
-#     """ Find the accuracy required to get the given amount of pp from this map. """
-#     if pyttanko is None:
-#         return None
-#
-#     ctx, beatmap_ctx = create_ctx(beatmap)
-#
-#     # Create the difficulty context for calculating
-#     diff_ctx = pyoppai.new_d_calc_ctx(ctx)
-#     mods_bitmask = apply_settings(beatmap_ctx, args)
-#     stars, aim, speed, _, _, _, _ = pyoppai.d_calc(diff_ctx, beatmap_ctx)
-#
-#     # Define a partial command for easily setting the pp value by 100s count
-#     def calc(accuracy: float):
-#         return pyoppai.pp_calc_acc(
-#             ctx, aim, speed, beatmap_ctx, accuracy, mods_bitmask, args.combo, args.misses, args.score_version)[1]
-#
-#     # Find the smallest possible value oppai is willing to give
-#     min_pp = calc(accuracy=0.0)
-#     if args.pp <= min_pp:
-#         raise ValueError("The given pp value is too low (oppai gives **{:.02f}pp** at **0% acc**).".format(min_pp))
-#
-#     # Calculate the max pp value by using 100% acc
-#     previous_pp = calc(accuracy=100.0)
-#
-#     if args.pp >= previous_pp:
-#         raise ValueError("PP value should be below **{:.02f}pp** for this map.".format(previous_pp))
-#
-#     dec = .05
-#     acc = 100.0 - dec
-#     while True:
-#         current_pp = calc(accuracy=acc)
-#
-#         # Stop when we find a pp value between the current 100 count and the previous one
-#         if current_pp <= args.pp <= previous_pp:
-#             break
-#         else:
-#             previous_pp = current_pp
-#             acc -= dec
-#
-#     # Find the closest pp of our two values, and return the amount of 100s
-#     closest_pp = min([previous_pp, current_pp], key=lambda v: abs(args.pp - v))
-#     acc = acc if closest_pp == current_pp else acc + dec
-#     return ClosestPPStats(round(acc, 2), closest_pp, stars, pyoppai.artist(beatmap_ctx), pyoppai.title(beatmap_ctx),
-#                           pyoppai.version(beatmap_ctx))
+async def calculate_pp_batch(beatmap_url_or_id, options_list: list, ignore_cache: bool=False):
+    """ Return a list of PPStats of a beatmap, one for every set of options, calculated
+    from a single parsed beatmap.
+
+    :param beatmap_url_or_id: beatmap_url as str or the id as int
+    :param options_list: A list of options for each calculation, each a list of str as given to calculate_pp.
+    :param ignore_cache: When true, the .osu will always be downloaded
+    :raise ValueError: The beatmap or any options are invalid, or the calculation failed.
+    """
+    beatmap = await parse_map(beatmap_url_or_id, ignore_cache=ignore_cache)
+    calculations = [get_calculation_options(parse_options(*options)) for options in options_list]
+    return await run_calculations(beatmap, calculations)
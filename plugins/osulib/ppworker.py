@@ -0,0 +1,136 @@
+""" pp calculations run in worker processes by osulib.pp.
+
+Every worker keeps the most recently used beatmaps parsed by oppai-ng, so
+that calculating another score on the same beatmap does not parse the
+.osu file again. Only plain values are passed to and from the workers.
+"""
+
+from collections import OrderedDict
+
+try:
+    from oppai import *
+except:
+    pass
+
+max_warm_beatmaps = 8
+accuracy_precision = 0.005  # The accuracy in percent which find_closest_pp bisects down to
+warm_beatmaps = OrderedDict()  # md5: ezpp handle with the beatmap parsed
+
+
+def get_ezpp(md5: str, beatmap: str):
+    """ Return the ezpp handle of a beatmap, parsing it if this worker has not already. """
+    if md5 in warm_beatmaps:
+        warm_beatmaps.move_to_end(md5)
+        return warm_beatmaps[md5]
+
+    ez = ezpp_new()
+    ezpp_set_autocalc(ez, 1)
+    ezpp_data_dup(ez, beatmap, len(beatmap.encode(errors="replace")))
+    warm_beatmaps[md5] = ez
+
+    while len(warm_beatmaps) > max_warm_beatmaps:
+        _, evicted = warm_beatmaps.popitem(last=False)
+        ezpp_free(evicted)
+
+    return ez
+
+
+def calculate(ez, options: dict):
+    """ Calculate the pp of a parsed beatmap with the given options.
+
+    Every setting is given, since the handle keeps the settings of its previous calculation.
+    A value of -1 makes oppai-ng use the beatmap's own value.
+
+    :return: A tuple of the fields in osulib.pp.PPStats.
+    """
+    # Set accuracy based on arguments
+    if options["acc"] is not None:
+        ezpp_set_accuracy_percent(ez, options["acc"])
+    else:
+        ezpp_set_accuracy(ez, options["c100"], options["c50"])
+
+    # Set args if needed
+    # TODO: these don't seem to actually be applied in calculation, although
+    # they work in the native C version of oppai-ng
+    ezpp_set_base_ar(ez, options["ar"] or -1)
+    ezpp_set_base_hp(ez, options["hp"] or -1)
+    ezpp_set_base_od(ez, options["od"] or -1)
+    ezpp_set_base_cs(ez, options["cs"] or -1)
+
+    # Set combo
+    ezpp_set_combo(ez, options["combo"] if options["combo"] is not None else -1)
+
+    # Apply the mods and calculate the star difficulty
+    ezpp_set_mods(ez, options["mods"])
+    stars = ezpp_stars(ez)
+
+    # Set number of misses and the score version
+    ezpp_set_nmiss(ez, options["misses"])
+    ezpp_set_score_version(ez, options["score_version"])
+
+    return (ezpp_pp(ez), stars, ezpp_artist(ez), ezpp_title(ez), ezpp_version(ez),
+            ezpp_ar(ez), ezpp_od(ez), ezpp_hp(ez), ezpp_cs(ez))
+
+
+def find_closest_pp(ez, options: dict):
+    """ Find the accuracy at which a parsed beatmap is worth the pp given in the options.
+
+    pp never decreases with accuracy, so the accuracy is bisected, which takes around
+    15 calculations rather than stepping down from 100%.
+
+    :return: A tuple of the fields in osulib.pp.ClosestPPStats.
+    :raise ValueError: The pp can't be reached at any accuracy.
+    """
+    target = options["pp"]
+
+    def calc(acc: float):
+        ezpp_set_accuracy_percent(ez, acc)
+        return ezpp_pp(ez)
+
+    # Apply every other option and find the smallest possible value oppai is willing to give
+    low, low_pp = 0.0, calculate(ez, dict(options, acc=0.0))[0]
+    if target <= low_pp:
+        raise ValueError("The given pp value is too low (oppai gives **{:.02f}pp** at **0% acc**).".format(low_pp))
+
+    # Calculate the max pp value by using 100% acc
+    high, high_pp = 100.0, calc(100.0)
+    if target >= high_pp:
+        raise ValueError("PP value should be below **{:.02f}pp** for this map.".format(high_pp))
+
+    while high - low > accuracy_precision:
+        acc = (low + high) / 2
+        pp = calc(acc)
+        if pp < target:
+            low, low_pp = acc, pp
+        else:
+            high, high_pp = acc, pp
+
+    # Use the closest of the two accuracies, and leave its hit counts in the handle
+    acc, pp = (low, low_pp) if target - low_pp < high_pp - target else (high, high_pp)
+    calc(acc)
+    return (round(acc, 2), pp, ezpp_stars(ez), ezpp_artist(ez), ezpp_title(ez), ezpp_version(ez),
+            ezpp_n100(ez), ezpp_n50(ez))
+
+
+def calculate_many(md5: str, beatmap: str, options_list: list):
+    """ Calculate the pp of a beatmap for every dict of options. When the options
+    include pp, the accuracy giving that pp is found instead.
+
+    :param md5: The md5 of the .osu file, identifying the beatmap among the warm beatmaps.
+    :param beatmap: The contents of the .osu file.
+    :return: A list of tuples with the fields in osulib.pp.PPStats or osulib.pp.ClosestPPStats,
+        or the ValueError of calculations that failed.
+    """
+    ez = get_ezpp(md5, beatmap)
+    results = [None] * len(options_list)
+
+    # Calculations with the same mods are run one after another, so that the star difficulty
+    # is only calculated once for every set of mods
+    for i in sorted(range(len(options_list)), key=lambda i: options_list[i]["mods"]):
+        options = options_list[i]
+        try:
+            results[i] = calculate(ez, options) if options.get("pp") is None else find_closest_pp(ez, options)
+        except ValueError as e:
+            results[i] = e
+
+    return results
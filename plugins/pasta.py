@@ -11,26 +11,27 @@ from random import choice
 import discord
 import asyncio
 
-from pcbot import Config, Annotate, convert_to_embed
+from pcbot import Config, Annotate, convert_to_embed, triggers
 import plugins
 client = plugins.client  # type: discord.Client
 
 
 pastas = Config("pastas", data={})
-pasta_cache = {}  # list of generate_pasta tuples to cache
+pasta_cache = plugins.ResponseCache(name="pasta")  # generate_pasta tuples by name
 embed_color = discord.Color.dark_grey()
 
 
 async def generate_pasta(name: str):
     """ Generate a pasta embed. """
-    # Return the optionally cached result
-    if name in pasta_cache:
-        return pasta_cache[name]
-
     # Choose a random pasta when the name is .
     if name == ".":
         name = choice(list(pastas.data.keys()))
 
+    # Return the optionally cached result
+    generated = pasta_cache.get(name)
+    if generated is not None:
+        return generated
+
     # Remove spaces as pastas are space independent
     parsed_name = name.replace(" ", "")
 
@@ -50,7 +51,7 @@ async def generate_pasta(name: str):
 
     # Cache the result and return
     generated = (embed, content)
-    pasta_cache[name] = generated
+    pasta_cache.set(name, generated)
     return generated
 
 
@@ -73,6 +74,7 @@ async def add(message: discord.Message, name: str.lower, copypasta: Annotate.Con
     # If the pasta doesn't exist, set it
     pastas.data[parsed_name] = copypasta
     pastas.save()
+    pasta_cache.invalidate()
     await client.say(message, "Pasta `{}` set.".format(name))
 
 
@@ -86,11 +88,15 @@ async def remove(message: discord.Message, name: Annotate.LowerContent):
 
     copypasta = pastas.data.pop(parsed_name)
     pastas.save()
+    pasta_cache.invalidate()
     await client.say(message, "Pasta `{}` removed. In case this was a mistake, "
                                    "here's the pasta: ```{}```".format(name, copypasta))
 
 
-@plugins.event()
+triggers.set_triggers("pasta", patterns=[r"\A\|(?!\|)"])
+
+
+@plugins.event(triggers="pasta")
 async def on_message(message: discord.Message):
     """ Use shorthand |<pasta ...> for displaying pastas and remove the user's message. """
     if message.content.startswith("|") and not message.content.startswith("||"):
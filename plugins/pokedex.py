@@ -36,6 +36,15 @@ min_scale_factor, max_scale_factor = 0.25, 4
 
 pokemon_go_gen = [1, 2, 3]
 
+
+def can_attach_files(message: discord.Message):
+    """ Return True if the bot can send the pokédex sprite in the message's channel. """
+    return message.server is None or message.channel.permissions_for(message.server.me).attach_files
+
+
+# The sprite is scaled per server, and only sent when the bot can attach files
+pokedex_cache = plugins.ResponseCache(maxsize=128, per_server=True, key=can_attach_files)
+
 # Load the Pokedex API
 with open(api_path) as api_file:
     api = json.load(api_file)
@@ -123,7 +132,7 @@ def get_pokemon(name_or_id: str, assert_on_error: bool=True):
     return name
 
 
-@plugins.command(name="pokedex", aliases="pd pokemon dex")
+@plugins.command(name="pokedex", aliases="pd pokemon dex", cache=pokedex_cache)
 async def pokedex_(message: discord.Message, name_or_id: Annotate.LowerCleanContent):
     """ Display some information of the given pokémon.
 
@@ -146,7 +155,7 @@ async def pokedex_(message: discord.Message, name_or_id: Annotate.LowerCleanCont
     pokemon = pokedex[name]
 
     # Send an image if the bots has Attach Files permission or the message is a dm
-    if message.server is None or message.channel.permissions_for(message.server.me).attach_files:
+    if can_attach_files(message):
         # Get the server's scale factor
         if not message.channel.is_private \
                 and message.server.id in pokedex_config.data and "scale-factor" in pokedex_config.data[message.server.id]:
@@ -203,7 +212,7 @@ async def pokedex_(message: discord.Message, name_or_id: Annotate.LowerCleanCont
     await client.say(message, formatted_message)
 
 
-@pokedex_.command()
+@pokedex_.command(cache=True)
 async def egg(message: discord.Message, egg_type: Annotate.LowerCleanContent):
     """ Get the pokemon hatched from the specified egg_type
     (in distance, e.g. 2 or 5km) """
@@ -359,7 +368,7 @@ async def filter_type(message: discord.Message, slot_1: str.lower, slot_2: str.l
         format_type(slot_1, slot_2), ", ".join(sorted(matched_pokemon))))
 
 
-@pokedex_.command(aliases="e",
+@pokedex_.command(aliases="e", cache=True,
                   description="Display type efficacy (effectiveness) of the specified type or pokemon. {}".format(types_str))
 async def effect(message: discord.Message, slot_1_or_pokemon: str.lower, slot_2: str.lower=None):
     name = get_pokemon(slot_1_or_pokemon, assert_on_error=False)
@@ -405,4 +414,5 @@ async def scalefactor(message: discord.Message, factor: float=default_scale_fact
         reply = "Pokédex image scale factor set to **{factor}**."
 
     pokedex_config.save()
+    pokedex_cache.invalidate(message.server)
     await client.say(message, reply.format(factor=factor))
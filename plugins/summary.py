@@ -44,8 +44,9 @@ summary_options = Config("summary_options", data=dict(no_bot=False, no_self=Fals
 summary_data = Config("summary_data", data=dict(channels={}))
 
 
-def to_persistent(message: discord.Message):
-    return dict(content=message.clean_content, author=message.author.id, bot=message.author.bot)
+def to_persistent(message: discord.Message, clean_content: str=None):
+    return dict(content=clean_content if clean_content is not None else message.clean_content,
+                author=message.author.id, bot=message.author.bot)
 
 
 async def update_messages(channel: discord.Channel):
@@ -84,6 +85,11 @@ async def on_reload(name: str):
     stored_messages = local_messages
 
 
+async def save(_):
+    """ Save the persistent messages stored since the last save. """
+    summary_data.save()
+
+
 def indexes_of_word(words: list, word: str):
     """ Return a list of indexes with the given word. """
     return [i for i, s in enumerate(words) if s.lower() == word]
@@ -327,6 +333,7 @@ async def summary(message: discord.Message, *options, phrase: Annotate.Content=N
             markovify_model = None
 
     # Generate the summary, or num summaries
+    sentences = []
     for i in range(num):
         if strict and markovify_model:
             if phrase and is_endswith(phrase):
@@ -343,24 +350,28 @@ async def summary(message: discord.Message, *options, phrase: Annotate.Content=N
         if not sentence:
             sentence = markov_messages(message_content, coherent)
 
-        assert sentence, on_fail.format(message)
+        if not sentence:
+            break
 
         # Convert new line identifiers back to characters
-        sentence = sentence.replace(NEW_LINE_IDENTIFIER.strip(" "), "\n")
+        sentences.append(sentence.replace(NEW_LINE_IDENTIFIER.strip(" "), "\n"))
 
-        await client.send_message(message.channel, sentence, tts=tts)
+    # Queue the summaries together, so that they can be joined into as few messages as possible
+    await asyncio.gather(*(client.send_message(message.channel, sentence, tts=tts, coalesce=True)
+                           for sentence in sentences))
+    assert len(sentences) == num, on_fail.format(message)
 
 
-@plugins.event(bot=True, self=True)
-async def on_message(message: discord.Message):
+@plugins.event(bot=True, self=True, pass_context=True)
+async def on_message(message: discord.Message, context: utils.MessageContext):
     """ Whenever a message is sent, see if we can update in one of the channels. """
     if message.channel.id in stored_messages and message.content:
-        stored_messages[message.channel.id].append(to_persistent(message))
+        stored_messages[message.channel.id].append(to_persistent(message, context.clean_content))
     
     # Store to persistent if enabled for this channel
     if message.channel.id in summary_options.data["persistent_channels"]:
-        summary_data.data["channels"][message.channel.id].append(to_persistent(message))
-        summary_data.save()
+        summary_data.data["channels"][message.channel.id].append(to_persistent(message, context.clean_content))
+        plugins.mark_dirty()
 
 
 @summary.command(owner=True)
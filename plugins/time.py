@@ -134,7 +134,7 @@ async def create(message: discord.Message, tag: tag_arg, *time, timezone: tz_arg
     time_cfg.save()
     await client.say(message, "Added countdown with tag `{}`.".format(tag))
 
-    client.loop.create_task(wait_for_reminder(cd, seconds))
+    plugins.create_task(wait_for_reminder(cd, seconds))
 
 
 @countdown.command(aliases="remove")
@@ -146,7 +146,7 @@ async def delete(message: discord.Message, tag: Annotate.Content):
 
     author_id = time_cfg.data["countdown"][tag]["author"]
     assert message.author.id == author_id, "You are not the author of this tag ({}).".format(
-        getattr(discord.utils.get(client.get_all_members(), id=author_id), "name", None) or "~~Unknown~~")
+        getattr(client.get_any_member(author_id), "name", None) or "~~Unknown~~")
 
     del time_cfg.data["countdown"][tag]
     time_cfg.save()
@@ -220,4 +220,4 @@ async def handle_countdown_reminders():
 
 async def on_ready():
     """ Start a task for startup countdowns. """
-    client.loop.create_task(handle_countdown_reminders())
+    plugins.create_task(handle_countdown_reminders(), name="countdown_reminders")
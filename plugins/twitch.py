@@ -66,16 +66,8 @@ def make_twitch_embed(member: discord.Member, response: dict):
     return e
 
 
-def started_streaming(before: discord.Member, after: discord.Member):
-    """ Return True if the member just started streaming, and did not do so recently. """
-    # The member is not streaming at the moment
-    if after.game is None or not after.game.type == 1:
-        return False
-
-    # Check if they were also streaming before
-    if before.game and before.game.type == 1:
-        return False
-
+def started_streaming(after: discord.Member):
+    """ Return True if the member, who just started streaming, did not do so recently. """
     # Update the stream history
     previous_stream = stream_history.get(after.id)
     stream_history[after.id] = datetime.now()
@@ -87,22 +79,22 @@ def started_streaming(before: discord.Member, after: discord.Member):
     return True
 
 
-@plugins.event()
+@plugins.event(changes=plugins.MemberChange.streaming_started)
 async def on_member_update(before: discord.Member, after: discord.Member):
     """ Notify given channels whenever a member goes live. """
     # Return if the server doesn't have any notify channels setup
     if not twitch_config.data["servers"].get(after.server.id, {}).get("notify_channels", False):
         return
 
-    # Make sure the member just started streaming
-    if not started_streaming(before, after):
+    # Make sure the member did not just restart their stream
+    if not started_streaming(after):
         return
 
     # Tru getting the id and also log some possibly useful info during exceptions
     try:
         twitch_id = await twitch.get_id(after)
     except twitch.RequestFailed as e:  # Could not find the streamer due to a request error
-        logging.info("Could not get twitch id of {}: {}".format(after, e))
+        logging.info("Could not get twitch id of %s: %s", after, e)
         return
     except twitch.UserNotResolved as e:  # Ignore them if the id was not found.
         logging.debug(e)
@@ -112,7 +104,7 @@ async def on_member_update(before: discord.Member, after: discord.Member):
     try:
         stream_response = await twitch.request("streams/" + twitch_id)
     except twitch.RequestFailed as e:
-        logging.info("Could not get twitch stream of {} (id: {}): {}".format(after, twitch_id, e))
+        logging.info("Could not get twitch stream of %s (id: %s): %s", after, twitch_id, e)
         return
 
     # If the member isn't actually streaming, return (should not be the case as discord uses the twitch api too)
@@ -122,4 +114,4 @@ async def on_member_update(before: discord.Member, after: discord.Member):
     # Create the embedded message and send it to every stream channel
     embed = make_twitch_embed(after, stream_response)
     for channel_id in twitch_config.data["servers"][after.server.id]["notify_channels"]:
-        await client.send_message(after.server.get_channel(channel_id), embed=embed)
+        await client.send_message(after.server.get_channel(channel_id), embed=embed, background=True)
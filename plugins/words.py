@@ -15,7 +15,7 @@ antonyms = load_wordlist("Antonyms-All")
 synonyms = load_wordlist("Synonyms-All")
 
 
-@plugins.command()
+@plugins.command(cache=True)
 async def antonym(message: discord.Message, phrase: Annotate.CleanContent):
     phrase = phrase.lower()
     
@@ -27,7 +27,7 @@ async def antonym(message: discord.Message, phrase: Annotate.CleanContent):
     await client.say(message, ", ".join(s.strip(" \n") for s in antonyms[phrase]))
 
 
-@plugins.command()
+@plugins.command(cache=True)
 async def synonym(message: discord.Message, phrase: Annotate.CleanContent):
     phrase = phrase.lower()
     